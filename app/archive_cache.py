@@ -0,0 +1,120 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+INDEX_NAME = "index.json"
+
+
+class ArchiveCache:
+    """
+    Size-bounded on-disk cache of downloaded backup objects, evicted least recently used first.
+
+    An entry is keyed by object key and valid only while the object's ETag is unchanged, so a
+    re-uploaded backup is downloaded again. Entries in use by a restore are pinned and never
+    evicted. The index is kept in `index.json` so the cache survives restarts.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = {}
+        self._pins = {}
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    def _path(self, key):
+        name = hashlib.sha256(key.encode()).hexdigest()[:32]
+        return os.path.join(self.directory, name + os.path.splitext(key)[1])
+
+    def _load_index(self):
+        try:
+            with open(os.path.join(self.directory, INDEX_NAME)) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            entries = {}
+        self._entries = {key: entry for key, entry in entries.items() if os.path.exists(self._path(key))}
+
+    def _save_index(self):
+        tmp = os.path.join(self.directory, INDEX_NAME + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump(self._entries, f)
+        os.replace(tmp, os.path.join(self.directory, INDEX_NAME))
+
+    @property
+    def size(self):
+        return sum(entry["size"] for entry in self._entries.values())
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 2) if lookups else None,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "size_bytes": self.size,
+                "max_bytes": self.max_bytes,
+            }
+
+    def acquire(self, key, etag, size, download):
+        """
+        Returns a local path holding object `key` at `etag`, calling `download(path)` on a miss.
+        The entry stays pinned until release(key). Returns None when the object is larger than
+        the whole cache; the caller downloads it on its own then.
+        """
+        if size > self.max_bytes:
+            return None
+        path = self._path(key)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry["etag"] == etag and os.path.exists(path):
+                self.hits += 1
+                entry["last_used"] = time.time()
+                self._pins[key] = self._pins.get(key, 0) + 1
+                self._save_index()
+                return path
+            self.misses += 1
+
+        tmp = f"{path}.{threading.get_ident()}.part"
+        try:
+            download(tmp)
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+        with self._lock:
+            os.replace(tmp, path)
+            self._entries[key] = {"etag": etag, "size": size, "last_used": time.time()}
+            self._pins[key] = self._pins.get(key, 0) + 1
+            self._evict()
+            self._save_index()
+        return path
+
+    def release(self, key):
+        with self._lock:
+            if self._pins.get(key, 0) > 1:
+                self._pins[key] -= 1
+            else:
+                self._pins.pop(key, None)
+
+    def _evict(self):
+        total = self.size
+        for key in sorted(self._entries, key=lambda k: self._entries[k]["last_used"]):
+            if total <= self.max_bytes:
+                break
+            if key in self._pins:
+                continue
+            total -= self._entries.pop(key)["size"]
+            self.evictions += 1
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
@@ -1,9 +1,33 @@
 import os
+import json
+import shutil
 import subprocess
 import datetime
-import boto3
+import threading
+import time
 import psycopg2
 from botocore.exceptions import NoCredentialsError
+from .storage import get_s3_client
+from .streaming import MultipartUploader, stream_dump, pipe_into_process, read_file_chunks, MB
+from .codecs import MeasuredCompressor, build_compressor, get_codec, codec_for_key
+from .parallel_dump import dump_directory
+from .restore import detect_backup_format, download_directory_backup, pg_restore
+from .export import export_snapshot_backup, restore_snapshot_backup
+from .incremental import apply_delta, backup_chain, change_filter, schema_matches
+from .dedup import DedupWriter, known_chunks, write_recipe, load_recipe, read_chunks, RECIPE_SUFFIX
+from .transfer import ResumableUpload, pending_uploads, ranged_chunks, ranged_download, CHECKPOINT_SUFFIX
+from .catalog import cached_backups, catalog_entry, read_catalog, rebuild_catalog, update_catalog, walk_backups, sorted_backups
+from .archive_cache import ArchiveCache
+from .subset import load_relations, subset_filter, SUBSET_SUFFIX
+from .selective import restore_tables, CLOSURES
+from .testdb import maintenance_connection, database_of, database_url, create_database, clone_database, mark_template, swap_in, drop_database
+from .retention import plan_retention, plan_archive_retention, backup_objects, delete_keys, unreferenced_chunks
+from .layout import key_for, day_prefixes, database_name, LAYOUT_FLAT
+from .wal import WalArchiver, base_backup, drop_slot, point_in_time_restore, pitr_unavailable
+from .manifest import (
+    new_manifest, write_manifest, load_manifest, file_sha256, table_stats, PlainDumpIndexer,
+    FORMAT_PLAIN, FORMAT_CUSTOM, FORMAT_DIRECTORY, FORMAT_DEDUP,
+)
 
 def get_config():
     return {
@@ -13,75 +37,498 @@ def get_config():
         "R2_ACCESS_KEY_ID": os.getenv("R2_ACCESS_KEY_ID"),
         "R2_SECRET_ACCESS_KEY": os.getenv("R2_SECRET_ACCESS_KEY"),
         "R2_BUCKET_NAME": os.getenv("R2_BUCKET_NAME"),
+        "BACKUP_MODE": os.getenv("BACKUP_MODE", "file"),
+        "STREAM_PART_SIZE_MB": int(os.getenv("STREAM_PART_SIZE_MB", 8)),
+        "STREAM_MAX_PENDING_PARTS": int(os.getenv("STREAM_MAX_PENDING_PARTS", 4)),
+        "UPLOAD_PART_SIZE_MB": int(os.getenv("UPLOAD_PART_SIZE_MB", 16)),
+        "UPLOAD_CONCURRENCY": int(os.getenv("UPLOAD_CONCURRENCY", 8)),
+        "UPLOAD_MULTIPART_THRESHOLD_MB": int(os.getenv("UPLOAD_MULTIPART_THRESHOLD_MB", 64)),
+        "UPLOAD_RETRIES": int(os.getenv("UPLOAD_RETRIES", 3)),
+        "DOWNLOAD_RANGE_MB": int(os.getenv("DOWNLOAD_RANGE_MB", 16)),
+        "DOWNLOAD_CONCURRENCY": int(os.getenv("DOWNLOAD_CONCURRENCY", 8)),
+        "DOWNLOAD_RETRIES": int(os.getenv("DOWNLOAD_RETRIES", 3)),
+        "ARCHIVE_CACHE_DIR": os.getenv("ARCHIVE_CACHE_DIR", "/tmp/archive_cache"),
+        "ARCHIVE_CACHE_MB": int(os.getenv("ARCHIVE_CACHE_MB", 2048)),
+        "BACKUP_KEY_LAYOUT": os.getenv("BACKUP_KEY_LAYOUT", LAYOUT_FLAT),
+        "CATALOG_CACHE_SECONDS": int(os.getenv("CATALOG_CACHE_SECONDS", 60)),
+        "RETENTION_ENABLED": os.getenv("RETENTION_ENABLED", "false").lower() == "true",
+        "RETENTION_KEEP_HOURLY": int(os.getenv("RETENTION_KEEP_HOURLY", 24)),
+        "RETENTION_KEEP_DAILY": int(os.getenv("RETENTION_KEEP_DAILY", 7)),
+        "RETENTION_KEEP_WEEKLY": int(os.getenv("RETENTION_KEEP_WEEKLY", 4)),
+        "RETENTION_KEEP_MONTHLY": int(os.getenv("RETENTION_KEEP_MONTHLY", 12)),
+        "RETENTION_KEEP_SUBSETS": int(os.getenv("RETENTION_KEEP_SUBSETS", 7)),
+        "RETENTION_KEEP_BASEBACKUPS": int(os.getenv("RETENTION_KEEP_BASEBACKUPS", 7)),
+        "BACKUP_JOBS": int(os.getenv("BACKUP_JOBS", 4)),
+        "RESTORE_JOBS": int(os.getenv("RESTORE_JOBS", 4)),
+        "RESTORE_MODE": os.getenv("RESTORE_MODE", "file"),
+        "TEST_TEMPLATE_DB": os.getenv("TEST_TEMPLATE_DB"),
+        "SHADOW_RESTORE": os.getenv("SHADOW_RESTORE", "false").lower() == "true",
+        "BACKUP_CODEC": os.getenv("BACKUP_CODEC", "gzip"),
+        "BACKUP_COMPRESSION_LEVEL": int(os.environ["BACKUP_COMPRESSION_LEVEL"]) if os.getenv("BACKUP_COMPRESSION_LEVEL") else None,
+        "BACKUP_COMPRESSION_THREADS": int(os.getenv("BACKUP_COMPRESSION_THREADS", os.cpu_count() or 1)),
+        "BACKUP_COMPRESSION_BLOCK_MB": int(os.getenv("BACKUP_COMPRESSION_BLOCK_MB", 4)),
+        "EXPORT_CHUNK_ROWS": int(os.getenv("EXPORT_CHUNK_ROWS", 500000)),
+        "DEDUP_MIN_CHUNK_KB": int(os.getenv("DEDUP_MIN_CHUNK_KB", 256)),
+        "DEDUP_MAX_CHUNK_KB": int(os.getenv("DEDUP_MAX_CHUNK_KB", 8192)),
+        "SUBSET_SEEDS": os.getenv("SUBSET_SEEDS", "[]"),
+        "SUBSET_FULL_TABLES": [t.strip() for t in os.getenv("SUBSET_FULL_TABLES", "").split(",") if t.strip()],
+        "SUBSET_CHILD_DEPTH": int(os.getenv("SUBSET_CHILD_DEPTH", 1)),
+        "SUBSET_LINK_TARGETS": os.getenv("SUBSET_LINK_TARGETS", "{}"),
+        "SCHEMA_METADATA_PATH": os.getenv("SCHEMA_METADATA_PATH", "schema_metadata.json"),
+        "EXPORT_REUSE_UNCHANGED": os.getenv("EXPORT_REUSE_UNCHANGED", "true").lower() == "true",
+        "FINGERPRINT_HASH_MAX_ROWS": int(os.getenv("FINGERPRINT_HASH_MAX_ROWS", 100000)),
+        "SKIP_UNCHANGED_BACKUPS": os.getenv("SKIP_UNCHANGED_BACKUPS", "true").lower() == "true",
+        "DOWNGRADE_MAX_ROW_CHANGES": int(os.getenv("DOWNGRADE_MAX_ROW_CHANGES", 0)),
+        "DOWNGRADE_MODE": os.getenv("DOWNGRADE_MODE", "incremental"),
+        "INCREMENTAL_FULL_EVERY": int(os.getenv("INCREMENTAL_FULL_EVERY", 24)),
+        "INCREMENTAL_OVERLAP_MINUTES": int(os.getenv("INCREMENTAL_OVERLAP_MINUTES", 5)),
+        "WAL_ARCHIVE_ENABLED": os.getenv("WAL_ARCHIVE_ENABLED", "false").lower() == "true",
+        "WAL_SLOT_NAME": os.getenv("WAL_SLOT_NAME", "backup_service"),
+        "WAL_SPOOL_DIR": os.getenv("WAL_SPOOL_DIR", "/tmp/wal_spool"),
+        "WAL_BATCH_SEGMENTS": int(os.getenv("WAL_BATCH_SEGMENTS", 16)),
+        "WAL_BATCH_SECONDS": int(os.getenv("WAL_BATCH_SECONDS", 60)),
+        "BASEBACKUP_INTERVAL_HOURS": int(os.getenv("BASEBACKUP_INTERVAL_HOURS", 24)),
+        "PG_BIN_DIR": os.getenv("PG_BIN_DIR", ""),
+        "PITR_PORT": int(os.getenv("PITR_PORT", 54329)),
     }
 
 def list_backups():
-    """Lists available backups in the R2 bucket."""
+    """
+    Lists available backups from the bucket's catalog index, cached in process for
+    CATALOG_CACHE_SECONDS and refreshed in the background, so the dashboard does not list
+    the bucket. The catalog is rebuilt by a full scan only if it is missing.
+    """
     config = get_config()
     validate_config(config, ["R2_ENDPOINT_URL", "R2_ACCESS_KEY_ID", "R2_SECRET_ACCESS_KEY", "R2_BUCKET_NAME"])
-    
-    s3 = boto3.client(
-        's3',
-        endpoint_url=config["R2_ENDPOINT_URL"],
-        aws_access_key_id=config["R2_ACCESS_KEY_ID"],
-        aws_secret_access_key=config["R2_SECRET_ACCESS_KEY"]
+    s3 = get_s3_client()
+    return cached_backups(s3, config["R2_BUCKET_NAME"], ttl=config["CATALOG_CACHE_SECONDS"])
+
+def rebuild_backup_catalog():
+    """Rescans the whole bucket and rewrites the catalog, e.g. after objects were changed by hand."""
+    config = get_config()
+    validate_config(config, ["R2_ENDPOINT_URL", "R2_ACCESS_KEY_ID", "R2_SECRET_ACCESS_KEY", "R2_BUCKET_NAME"])
+    backups = rebuild_catalog(get_s3_client(), config["R2_BUCKET_NAME"])
+    return True, f"Catalog rebuilt ({len(backups)} backups)"
+
+def _backup_key(config, name):
+    """Object key for a new backup called `name`, following BACKUP_KEY_LAYOUT."""
+    return key_for(name, config["BACKUP_KEY_LAYOUT"], database_name(config["DATABASE_URL"]))
+
+def list_recent_backups(days=7):
+    """
+    Backups from the last `days` days. With a dated BACKUP_KEY_LAYOUT only those days'
+    prefixes are listed (delimiter listing); with the flat layout the catalog is filtered.
+    """
+    config = get_config()
+    validate_config(config, ["R2_ENDPOINT_URL", "R2_ACCESS_KEY_ID", "R2_SECRET_ACCESS_KEY", "R2_BUCKET_NAME"])
+    s3 = get_s3_client()
+    since = datetime.date.today() - datetime.timedelta(days=days)
+    if config["BACKUP_KEY_LAYOUT"] == LAYOUT_FLAT:
+        cutoff = since.strftime("%Y-%m-%d")
+        return [b for b in cached_backups(s3, config["R2_BUCKET_NAME"], ttl=config["CATALOG_CACHE_SECONDS"]) if b["last_modified"] >= cutoff]
+    backups = {}
+    for prefix in day_prefixes(config["BACKUP_KEY_LAYOUT"], database_name(config["DATABASE_URL"]), since):
+        backups.update(walk_backups(s3, config["R2_BUCKET_NAME"], prefix))
+    return sorted_backups(backups)
+
+def _catalog_add(s3, config, filename, size):
+    """Records a finished backup in the catalog. A failure here does not fail the backup."""
+    try:
+        update_catalog(s3, config["R2_BUCKET_NAME"], add=[catalog_entry(filename, size)])
+    except Exception as e:
+        print(f"Failed to add {filename} to the backup catalog: {e}")
+
+def _reset_schema(target_url):
+    """Drops and recreates the public schema of `target_url` before a restore."""
+    subprocess.run(
+        ["psql", target_url, "-c", "DROP SCHEMA public CASCADE; CREATE SCHEMA public;"],
+        check=True, capture_output=True,
     )
-    
-    response = s3.list_objects_v2(Bucket=config["R2_BUCKET_NAME"])
-    if 'Contents' not in response:
-        return []
-    
-    # Sort by last modified descending
-    backups = sorted(response['Contents'], key=lambda x: x['LastModified'], reverse=True)
-    return [{
-        "filename": b['Key'],
-        "size": b['Size'],
-        "last_modified": b['LastModified'].strftime("%Y-%m-%d %H:%M:%S")
-    } for b in backups]
 
-def perform_restore(filename):
+def perform_stream_restore(filename, fmt, codec, target_url):
+    """
+    Pipes a single-object backup from R2 straight into psql (plain) or pg_restore (custom),
+    decompressing on the fly, so nothing is written to local disk. The object is fetched
+    as DOWNLOAD_CONCURRENCY parallel ranged GETs and reassembled in order.
+    Custom archives restored this way load on one connection, since pg_restore
+    cannot run parallel jobs from stdin.
+    """
+    config = get_config()
+    try:
+        s3 = get_s3_client()
+
+        _reset_schema(target_url)
+
+        if fmt == FORMAT_CUSTOM:
+            command = ["pg_restore", "--no-owner", "--no-privileges", "--dbname", target_url]
+        else:
+            command = ["psql", target_url, "--quiet"]
+        chunks = ranged_chunks(
+            s3,
+            config["R2_BUCKET_NAME"],
+            filename,
+            range_size=config["DOWNLOAD_RANGE_MB"] * MB,
+            concurrency=config["DOWNLOAD_CONCURRENCY"],
+            retries=config["DOWNLOAD_RETRIES"],
+        )
+        pipe_into_process(chunks, command, codec.decompressor())
+        return True, f"Successfully restored {filename} to Test DB"
+    except subprocess.CalledProcessError as e:
+        return False, f"Restore failed: {e.stderr.decode()}"
+    except Exception as e:
+        return False, f"Unexpected error: {str(e)}"
+
+def perform_dedup_restore(filename, target_url):
+    """
+    Rebuilds a dedup backup's SQL stream from its chunk list and pipes it into psql,
+    fetching chunks ahead in parallel.
+    """
+    config = get_config()
+    try:
+        s3 = get_s3_client()
+        recipe = load_recipe(s3, config["R2_BUCKET_NAME"], filename)
+
+        _reset_schema(target_url)
+
+        chunks = read_chunks(s3, config["R2_BUCKET_NAME"], recipe, get_codec(recipe["codec"]))
+        pipe_into_process(chunks, ["psql", target_url, "--quiet"])
+        return True, f"Successfully restored {filename} to Test DB"
+    except subprocess.CalledProcessError as e:
+        return False, f"Restore failed: {e.stderr.decode()}"
+    except Exception as e:
+        return False, f"Unexpected error: {str(e)}"
+
+def get_backup_manifest(filename):
+    """Returns the manifest of a backup (or None), without touching the backup itself."""
+    config = get_config()
+    validate_config(config, ["R2_ENDPOINT_URL", "R2_ACCESS_KEY_ID", "R2_SECRET_ACCESS_KEY", "R2_BUCKET_NAME"])
+    s3 = get_s3_client()
+    return load_manifest(s3, config["R2_BUCKET_NAME"], filename)
+
+def perform_copy_restore(filename, target_url):
+    """
+    Restores a snapshot COPY backup (text or binary), loading its chunks over
+    RESTORE_JOBS connections with COPY FROM STDIN. For an incremental backup, its full
+    base is restored first and every delta up to `filename` is applied on top.
+    """
+    config = get_config()
+    try:
+        s3 = get_s3_client()
+
+        _reset_schema(target_url)
+
+        # Incremental backups replay their full base, then each delta in order.
+        chain = backup_chain(s3, config["R2_BUCKET_NAME"], filename)
+        base = chain[0]
+        restore_snapshot_backup(s3, config["R2_BUCKET_NAME"], base["backup"], target_url, get_codec(base["codec"]), jobs=config["RESTORE_JOBS"])
+        for delta in chain[1:]:
+            apply_delta(s3, config["R2_BUCKET_NAME"], delta, target_url, get_codec(delta["codec"]))
+        if len(chain) > 1:
+            return True, f"Successfully restored {filename} to Test DB (full backup + {len(chain) - 1} incremental)"
+        return True, f"Successfully restored {filename} to Test DB"
+    except subprocess.CalledProcessError as e:
+        return False, f"Restore failed: {e.stderr.decode()}"
+    except Exception as e:
+        return False, f"Unexpected error: {str(e)}"
+
+def perform_pitr_restore(target_time, target_url=None):
+    """
+    Restores TEST_DATABASE_URL (or `target_url`) to the state of production at `target_time`
+    (ISO 8601, UTC if no offset is given) from the newest base backup before it plus archived WAL.
+    Requires PostgreSQL server binaries in PG_BIN_DIR.
+    """
+    config = get_config()
+    validate_config(config, ["DATABASE_URL", "TEST_DATABASE_URL", "R2_ENDPOINT_URL", "R2_ACCESS_KEY_ID", "R2_SECRET_ACCESS_KEY", "R2_BUCKET_NAME"])
+
+    if config["TEST_DATABASE_URL"] == config["DATABASE_URL"]:
+        return False, "Safety Error: TEST_DATABASE_URL is the same as production DATABASE_URL!"
+    unavailable = pitr_unavailable(config["PG_BIN_DIR"])
+    if unavailable:
+        return False, f"Point-in-time restore unavailable: {unavailable}"
+    if target_url is None and config["SHADOW_RESTORE"]:
+        return perform_shadow_restore(lambda url: perform_pitr_restore(target_time, target_url=url))
+    target_url = target_url or config["TEST_DATABASE_URL"]
+
+    try:
+        target = datetime.datetime.fromisoformat(target_time)
+        if target.tzinfo is None:
+            target = target.replace(tzinfo=datetime.timezone.utc)
+        s3 = get_s3_client()
+
+        _reset_schema(target_url)
+
+        base = point_in_time_restore(
+            s3,
+            config["R2_BUCKET_NAME"],
+            config["DATABASE_URL"],
+            target_url,
+            target,
+            codec_for_key,
+            pg_bin_dir=config["PG_BIN_DIR"],
+            port=config["PITR_PORT"],
+            download_concurrency=config["DOWNLOAD_CONCURRENCY"],
+        )
+        return True, f"Successfully restored Test DB to {target.isoformat()} (base {base['backup']} + WAL)"
+    except subprocess.CalledProcessError as e:
+        return False, f"Restore failed: {e.stderr.decode() if e.stderr else e}"
+    except Exception as e:
+        return False, f"Unexpected error: {str(e)}"
+
+def perform_restore(filename, target_url=None):
     """
     Downloads a backup from R2 and restores it to the TEST_DATABASE_URL.
+    Custom and directory archives are loaded with pg_restore using RESTORE_JOBS workers;
+    the format is read from the backup's metadata.
+    With SHADOW_RESTORE=true the backup is loaded into a separate database that is swapped
+    in only once it is complete (see perform_shadow_restore); `target_url` is that database.
+    With RESTORE_MODE=stream, single-object backups are piped in without a local copy.
+    Otherwise single-object downloads are kept in the archive cache (ARCHIVE_CACHE_MB), so
+    restoring the same backup again reads it from local disk.
     """
     config = get_config()
     validate_config(config, ["TEST_DATABASE_URL", "R2_ENDPOINT_URL", "R2_ACCESS_KEY_ID", "R2_SECRET_ACCESS_KEY", "R2_BUCKET_NAME"])
     
     if config["TEST_DATABASE_URL"] == config["DATABASE_URL"]:
         return False, "Safety Error: TEST_DATABASE_URL is the same as production DATABASE_URL!"
+    if target_url is None and config["SHADOW_RESTORE"]:
+        return perform_shadow_restore(lambda url: perform_restore(filename, target_url=url))
+    target_url = target_url or config["TEST_DATABASE_URL"]
 
-    filepath = f"/tmp/{filename}"
-    
-    # 1. Download from R2
+    if filename.endswith(".copy"):
+        return perform_copy_restore(filename, target_url)
+    if filename.endswith(RECIPE_SUFFIX):
+        return perform_dedup_restore(filename, target_url)
+
+    if config["RESTORE_MODE"] == "stream" and not filename.endswith(".dir"):
+        try:
+            s3 = get_s3_client()
+            fmt = detect_backup_format(s3, config["R2_BUCKET_NAME"], filename)
+            head = s3.head_object(Bucket=config["R2_BUCKET_NAME"], Key=filename)
+            codec = codec_for_key(filename, head.get("Metadata"))
+        except Exception as e:
+            return False, f"Download failed: {str(e)}"
+        return perform_stream_restore(filename, fmt, codec, target_url)
+
+    filepath = f"/tmp/{os.path.basename(filename)}"
+    cache = _archive_cache(config)
+    cached_path = None
+
+    def cleanup():
+        if cached_path:
+            cache.release(filename)
+        else:
+            _remove_path(filepath)
+
+    # 1. Download from R2, unless the archive cache holds this exact object
     try:
-        s3 = boto3.client(
-            's3',
-            endpoint_url=config["R2_ENDPOINT_URL"],
-            aws_access_key_id=config["R2_ACCESS_KEY_ID"],
-            aws_secret_access_key=config["R2_SECRET_ACCESS_KEY"]
-        )
-        s3.download_file(config["R2_BUCKET_NAME"], filename, filepath)
+        s3 = get_s3_client()
+        fmt = detect_backup_format(s3, config["R2_BUCKET_NAME"], filename)
+        codec = get_codec("none")
+        if fmt == FORMAT_DIRECTORY:
+            download_directory_backup(s3, config["R2_BUCKET_NAME"], filename, filepath, jobs=config["RESTORE_JOBS"])
+        else:
+            head = s3.head_object(Bucket=config["R2_BUCKET_NAME"], Key=filename)
+            codec = codec_for_key(filename, head.get("Metadata"))
+            download = lambda path: _download_archive(s3, config, filename, path)
+            cached_path = cache.acquire(filename, head["ETag"], head["ContentLength"], download) if cache else None
+            if cached_path:
+                filepath = cached_path
+            else:
+                download(filepath)
     except Exception as e:
+        _remove_path(filepath)
         return False, f"Download failed: {str(e)}"
 
     # 2. Reset and Restore
     try:
-        # Reset: Drop and recreate public schema
-        reset_cmd = f"psql '{config['TEST_DATABASE_URL']}' -c 'DROP SCHEMA public CASCADE; CREATE SCHEMA public;'"
-        subprocess.run(reset_cmd, shell=True, check=True, capture_output=True)
+        _reset_schema(target_url)
         
         # Restore
-        restore_cmd = f"psql '{config['TEST_DATABASE_URL']}' -f {filepath}"
-        subprocess.run(restore_cmd, shell=True, check=True, capture_output=True)
+        if fmt in (FORMAT_CUSTOM, FORMAT_DIRECTORY):
+            pg_restore(target_url, filepath, jobs=config["RESTORE_JOBS"])
+        elif codec.name != "none":
+            pipe_into_process(read_file_chunks(filepath), ["psql", target_url, "--quiet"], codec.decompressor())
+        else:
+            restore_cmd = f"psql '{target_url}' -f {filepath}"
+            subprocess.run(restore_cmd, shell=True, check=True, capture_output=True)
         
-        os.remove(filepath)
+        cleanup()
         return True, f"Successfully restored {filename} to Test DB"
     except subprocess.CalledProcessError as e:
-        if os.path.exists(filepath): os.remove(filepath)
+        cleanup()
         return False, f"Restore failed: {e.stderr.decode()}"
     except Exception as e:
-        if os.path.exists(filepath): os.remove(filepath)
+        cleanup()
         return False, f"Unexpected error: {str(e)}"
 
+def perform_shadow_restore(restore):
+    """
+    Runs `restore(url)` against a fresh shadow database next to the test DB, so the current
+    test data stays online while the backup loads and its indexes build. Once that succeeds
+    the shadow database replaces the test DB through renames in one transaction; a failed
+    restore just drops the shadow and leaves the test DB as it was. Needs CREATEDB.
+    Returns: (success: bool, message: str)
+    """
+    config = get_config()
+    database = database_of(config["TEST_DATABASE_URL"])
+    shadow = f"{database}_shadow"[:63]
+    try:
+        conn = maintenance_connection(config["TEST_DATABASE_URL"])
+        try:
+            cur = conn.cursor()
+            drop_database(cur, shadow)
+            create_database(cur, shadow)
+            success, message = restore(database_url(config["TEST_DATABASE_URL"], shadow))
+            if not success:
+                drop_database(cur, shadow)
+                return False, message
+            started = time.monotonic()
+            swap_in(cur, database, shadow)
+            swap_ms = round((time.monotonic() - started) * 1000)
+        finally:
+            conn.close()
+        return True, f"{message} (loaded in shadow database, swapped in {swap_ms} ms)"
+    except Exception as e:
+        return False, f"Shadow restore failed: {str(e)}"
+
+def perform_table_restore(filename, tables, closure="none"):
+    """
+    Refreshes only `tables` of the test DB from a backup, optionally with their foreign-key
+    closure ("parents" or "all", see fk_closure), in one transaction. Only those tables'
+    bytes are fetched: a plain dump's manifest byte ranges (ranged GETs of the covering
+    compressed blocks), a directory archive's data files, or a COPY backup's chunks.
+    Returns: (success: bool, message: str)
+    """
+    config = get_config()
+    validate_config(config, ["TEST_DATABASE_URL", "R2_ENDPOINT_URL", "R2_ACCESS_KEY_ID", "R2_SECRET_ACCESS_KEY", "R2_BUCKET_NAME"])
+    if config["TEST_DATABASE_URL"] == config["DATABASE_URL"]:
+        return False, "Safety Error: TEST_DATABASE_URL is the same as production DATABASE_URL!"
+    if closure not in CLOSURES:
+        return False, f"Unknown closure {closure} (choose from {', '.join(CLOSURES)})"
+    try:
+        s3 = get_s3_client()
+        manifest = load_manifest(s3, config["R2_BUCKET_NAME"], filename)
+        if manifest is None:
+            return False, f"{filename} has no manifest, so its tables cannot be located"
+        restored = restore_tables(
+            s3,
+            config["R2_BUCKET_NAME"],
+            filename,
+            manifest,
+            tables,
+            config["TEST_DATABASE_URL"],
+            closure=closure,
+            range_size=config["DOWNLOAD_RANGE_MB"] * MB,
+            concurrency=config["DOWNLOAD_CONCURRENCY"],
+            retries=config["DOWNLOAD_RETRIES"],
+        )
+        return True, f"Restored {len(restored)} tables from {filename}: {', '.join(restored)}"
+    except Exception as e:
+        return False, f"Table restore failed: {str(e)}"
+
+def _template_name(config):
+    return config["TEST_TEMPLATE_DB"] or f"{database_of(config['TEST_DATABASE_URL'])}_template"[:63]
+
+def prepare_test_template(filename):
+    """
+    Restores `filename` into the test DB once, then freezes a copy of it as a template
+    database (TEST_TEMPLATE_DB, default `<test db>_template`), so reset_test_db can bring the
+    test DB back to this backup without replaying it.
+    Returns: (success: bool, message: str)
+    """
+    config = get_config()
+    success, message = perform_restore(filename)
+    if not success:
+        return False, message
+    template = _template_name(config)
+    try:
+        conn = maintenance_connection(config["TEST_DATABASE_URL"])
+        try:
+            cur = conn.cursor()
+            drop_database(cur, template)
+            clone_database(cur, database_of(config["TEST_DATABASE_URL"]), template)
+            mark_template(cur, template)
+        finally:
+            conn.close()
+        set_state("test_template", {"backup": filename, "database": template, "created_at": datetime.datetime.now().isoformat(timespec="seconds")})
+        return True, f"Restored {filename} and saved it as template {template}"
+    except Exception as e:
+        return False, f"Template creation failed: {str(e)}"
+
+def reset_test_db():
+    """
+    Resets the test DB to the backup saved by prepare_test_template: a fresh database is
+    cloned from the template (a file-level copy) and renamed into place, which takes
+    seconds instead of a full restore. Needs CREATEDB on the test server.
+    Returns: (success: bool, message: str)
+    """
+    config = get_config()
+    validate_config(config, ["TEST_DATABASE_URL"])
+    if config["TEST_DATABASE_URL"] == config["DATABASE_URL"]:
+        return False, "Safety Error: TEST_DATABASE_URL is the same as production DATABASE_URL!"
+    template_info = get_state("test_template")
+    if not template_info:
+        return False, "No template yet: prepare one from a backup first"
+
+    database = database_of(config["TEST_DATABASE_URL"])
+    fresh = f"{database}_reset"[:63]
+    try:
+        conn = maintenance_connection(config["TEST_DATABASE_URL"])
+        try:
+            cur = conn.cursor()
+            drop_database(cur, fresh)
+            clone_database(cur, template_info["database"], fresh)
+            swap_in(cur, database, fresh)
+        finally:
+            conn.close()
+        return True, f"Test DB reset to {template_info['backup']} from template {template_info['database']}"
+    except Exception as e:
+        return False, f"Reset failed: {str(e)}"
+
+def get_test_template_info():
+    try:
+        return get_state("test_template")
+    except Exception:
+        return None
+
+_archive_caches = {}
+
+def _archive_cache(config):
+    """The process-wide archive cache, or None when ARCHIVE_CACHE_MB=0."""
+    if config["ARCHIVE_CACHE_MB"] <= 0:
+        return None
+    directory = config["ARCHIVE_CACHE_DIR"]
+    if directory not in _archive_caches:
+        _archive_caches[directory] = ArchiveCache(directory, config["ARCHIVE_CACHE_MB"] * MB)
+    cache = _archive_caches[directory]
+    cache.max_bytes = config["ARCHIVE_CACHE_MB"] * MB
+    return cache
+
+def archive_cache_stats():
+    cache = _archive_cache(get_config())
+    return cache.stats() if cache else None
+
+def _download_archive(s3, config, filename, path):
+    """Fetches a single-object backup with parallel ranged GETs and checks it against its manifest."""
+    ranged_download(
+        s3,
+        config["R2_BUCKET_NAME"],
+        filename,
+        path,
+        range_size=config["DOWNLOAD_RANGE_MB"] * MB,
+        concurrency=config["DOWNLOAD_CONCURRENCY"],
+        retries=config["DOWNLOAD_RETRIES"],
+    )
+    manifest = load_manifest(s3, config["R2_BUCKET_NAME"], filename)
+    if manifest and manifest.get("sha256") and file_sha256(path) != manifest["sha256"]:
+        raise ValueError(f"Checksum mismatch for {filename}: download does not match its manifest")
+
+def _remove_path(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.exists(path):
+        os.remove(path)
+
 
 def validate_config(config, keys):
     missing = [k for k in keys if not config.get(k)]
@@ -153,6 +600,21 @@ def init_db():
                 message TEXT
             );
         """)
+        # Compression telemetry, added after the table first shipped.
+        cur.execute("""
+            ALTER TABLE _admin_backup_logs
+                ADD COLUMN IF NOT EXISTS codec VARCHAR(20),
+                ADD COLUMN IF NOT EXISTS raw_size_bytes BIGINT,
+                ADD COLUMN IF NOT EXISTS compression_ratio REAL,
+                ADD COLUMN IF NOT EXISTS compress_mb_per_s REAL;
+        """)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS _admin_backup_state (
+                key VARCHAR(100) PRIMARY KEY,
+                value JSONB,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+        """)
         conn.commit()
         cur.close()
         conn.close()
@@ -160,36 +622,757 @@ def init_db():
     except Exception as e:
         print(f"Error initializing DB: {e}")
 
-def log_backup(status, filename, size, message):
+def log_backup(status, filename, size, message, compression=None):
+    """`compression` is an optional (codec name, MeasuredCompressor) pair for telemetry."""
+    codec_name, raw_size, ratio, mb_per_s = None, None, None, None
+    if compression:
+        codec_name, stats = compression
+        raw_size, ratio, mb_per_s = stats.raw_bytes, stats.ratio, stats.mb_per_second
     try:
         conn = get_db_connection()
         cur = conn.cursor()
         cur.execute("""
-            INSERT INTO _admin_backup_logs (status, filename, size_bytes, message)
-            VALUES (%s, %s, %s, %s)
-        """, (status, filename, size, message))
+            INSERT INTO _admin_backup_logs (status, filename, size_bytes, message, codec, raw_size_bytes, compression_ratio, compress_mb_per_s)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        """, (status, filename, size, message, codec_name, raw_size, ratio, mb_per_s))
         conn.commit()
         cur.close()
         conn.close()
     except Exception as e:
         print(f"Failed to log to DB: {e}")
 
-def perform_backup():
+def get_state(key):
+    """Returns the JSON value stored under `key` in _admin_backup_state, or None."""
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT value FROM _admin_backup_state WHERE key = %s", (key,))
+        row = cur.fetchone()
+        return row[0] if row else None
+    finally:
+        conn.close()
+
+def set_state(key, value):
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            INSERT INTO _admin_backup_state (key, value, updated_at) VALUES (%s, %s, CURRENT_TIMESTAMP)
+            ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value, updated_at = EXCLUDED.updated_at
+        """, (key, json.dumps(value)))
+        conn.commit()
+    finally:
+        conn.close()
+
+def _backup_compressor(config, codec):
+    return build_compressor(
+        codec,
+        level=config["BACKUP_COMPRESSION_LEVEL"],
+        threads=config["BACKUP_COMPRESSION_THREADS"],
+        block_size=config["BACKUP_COMPRESSION_BLOCK_MB"] * MB,
+    )
+
+def _collect_table_stats():
+    """Catalog estimates for the manifest; a failure here must not fail the backup."""
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        stats = table_stats(cur)
+        cur.close()
+        conn.close()
+        return stats
+    except Exception as e:
+        print(f"Failed to collect table stats: {e}")
+        return {}
+
+def _write_plain_manifest(s3, config, filename, codec, size, sha256, indexer, compressor=None):
+    """Sidecar manifest for a plain SQL backup: exact per-table rows and byte ranges, plus the block map."""
+    manifest = new_manifest(
+        filename,
+        FORMAT_PLAIN,
+        codec.name,
+        size=size,
+        sha256=sha256,
+        raw_size=indexer.raw_bytes,
+        tables=indexer.tables,
+        blocks=compressor.blocks if compressor else [],
+    )
+    write_manifest(s3, config["R2_BUCKET_NAME"], filename, manifest)
+    return manifest
+
+def _resumable_upload(s3, config, filename, filepath, metadata):
+    return ResumableUpload(
+        s3,
+        config["R2_BUCKET_NAME"],
+        filename,
+        filepath,
+        part_size=config["UPLOAD_PART_SIZE_MB"] * MB,
+        concurrency=config["UPLOAD_CONCURRENCY"],
+        threshold=config["UPLOAD_MULTIPART_THRESHOLD_MB"] * MB,
+        retries=config["UPLOAD_RETRIES"],
+        metadata=metadata,
+    )
+
+def _write_file_manifest(s3, config, filename, filepath, fmt, codec_name="none"):
+    """
+    Manifest for a file-mode backup, built from the local file as uploaded. A compressed
+    plain dump is decompressed to index it; its block map is not recovered.
+    """
+    file_size = os.path.getsize(filepath)
+    if fmt == FORMAT_PLAIN:
+        codec = get_codec(codec_name)
+        decompressor = codec.decompressor()
+        indexer = PlainDumpIndexer()
+        for chunk in read_file_chunks(filepath):
+            indexer.feed(decompressor.decompress(chunk))
+        return _write_plain_manifest(s3, config, filename, codec, file_size, file_sha256(filepath), indexer)
+    manifest = new_manifest(filename, fmt, "none", size=file_size, sha256=file_sha256(filepath), tables=_collect_table_stats())
+    write_manifest(s3, config["R2_BUCKET_NAME"], filename, manifest)
+    return manifest
+
+def _resume_pending_uploads(config):
+    """Finishes file-mode uploads that an earlier run left checkpointed in /tmp."""
+    checkpoints = pending_uploads("/tmp")
+    if not checkpoints:
+        return
+    s3 = get_s3_client()
+    for checkpoint in checkpoints:
+        try:
+            upload = ResumableUpload.from_checkpoint(
+                s3,
+                checkpoint,
+                concurrency=config["UPLOAD_CONCURRENCY"],
+                threshold=config["UPLOAD_MULTIPART_THRESHOLD_MB"] * MB,
+                retries=config["UPLOAD_RETRIES"],
+            )
+            if not os.path.exists(upload.path):
+                upload.abort()
+                continue
+            file_size = upload.upload()
+            _write_file_manifest(
+                s3, config, upload.key, upload.path,
+                upload.metadata.get("backup-format", FORMAT_PLAIN), upload.metadata.get("codec", "none"),
+            )
+        except Exception as e:
+            print(f"Resuming upload from {checkpoint} failed: {e}")
+            continue
+        os.remove(upload.path)
+        _catalog_add(s3, config, upload.key, file_size)
+        log_backup("SUCCESS", upload.key, file_size, f"Backup upload resumed and completed ({upload.resumed_parts} parts reused)")
+
+def perform_stream_backup():
+    """
+    Pipes pg_dump through BACKUP_CODEC straight into a multipart upload, without a temp file.
+    Memory use is bounded by STREAM_PART_SIZE_MB * STREAM_MAX_PENDING_PARTS.
+    Returns: (success: bool, message: str)
+    """
+    config = get_config()
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    filename = _backup_key(config, f"backup_{timestamp}.sql")
+
+    try:
+        codec = get_codec(config["BACKUP_CODEC"])
+        filename += codec.extension
+        print(f"Starting streaming backup: {filename}")
+        validate_config(config, ["DATABASE_URL", "R2_ENDPOINT_URL", "R2_ACCESS_KEY_ID", "R2_SECRET_ACCESS_KEY", "R2_BUCKET_NAME"])
+        s3 = get_s3_client()
+    except Exception as e:
+        err_msg = f"Upload failed: {str(e)}"
+        log_backup("FAILED", filename, 0, err_msg)
+        return False, err_msg
+
+    uploader = MultipartUploader(
+        s3,
+        config["R2_BUCKET_NAME"],
+        filename,
+        part_size=config["STREAM_PART_SIZE_MB"] * MB,
+        max_pending=config["STREAM_MAX_PENDING_PARTS"],
+        metadata={"backup-format": FORMAT_PLAIN, "codec": codec.name},
+    )
+    compressor = MeasuredCompressor(_backup_compressor(config, codec))
+    indexer = PlainDumpIndexer()
+    try:
+        raw_size = stream_dump(["pg_dump", config["DATABASE_URL"]], uploader, compressor, on_chunk=indexer.feed)
+        uploader.close()
+        _write_plain_manifest(s3, config, filename, codec, uploader.bytes_written, uploader.sha256.hexdigest(), indexer, compressor)
+    except subprocess.CalledProcessError as e:
+        uploader.abort()
+        err_msg = f"Dump failed: {e.stderr.decode()}"
+        log_backup("FAILED", filename, 0, err_msg)
+        return False, err_msg
+    except Exception as e:
+        uploader.abort()
+        err_msg = f"Upload failed: {str(e)}"
+        log_backup("FAILED", filename, 0, err_msg)
+        return False, err_msg
+
+    file_size = uploader.bytes_written
+    _catalog_add(s3, config, filename, file_size)
+    log_backup("SUCCESS", filename, file_size, f"Backup streamed successfully ({round(raw_size/(1024*1024), 2)} MB uncompressed)", compression=(codec.name, compressor))
+    return True, f"Backup successful ({round(file_size/(1024*1024), 2)} MB)"
+
+# Held by dedup backups and by chunk-store cleanup: a running dedup backup skips uploading
+# chunks it saw at start, so none of them may be removed until its recipe is written.
+_chunk_store_lock = threading.Lock()
+
+def perform_dedup_backup():
+    with _chunk_store_lock:
+        return _dedup_backup()
+
+def _dedup_backup():
+    """
+    Streams a plain pg_dump into the chunk store: the dump is cut into content-defined
+    chunks, each chunk is uploaded once as `chunks/<sha256>`, and the backup itself is a
+    `backup_<ts>.dedup` list of chunk hashes. Tables that did not change since the last
+    backup produce the same chunks, so only changed regions are uploaded.
+    Returns: (success: bool, message: str)
+    """
+    config = get_config()
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    filename = _backup_key(config, f"backup_{timestamp}{RECIPE_SUFFIX}")
+    print(f"Starting dedup backup: {filename}")
+
+    try:
+        validate_config(config, ["DATABASE_URL", "R2_ENDPOINT_URL", "R2_ACCESS_KEY_ID", "R2_SECRET_ACCESS_KEY", "R2_BUCKET_NAME"])
+        codec = get_codec(config["BACKUP_CODEC"])
+        s3 = get_s3_client()
+        writer = DedupWriter(
+            s3,
+            config["R2_BUCKET_NAME"],
+            codec,
+            level=config["BACKUP_COMPRESSION_LEVEL"],
+            known=known_chunks(s3, config["R2_BUCKET_NAME"]),
+            min_size=config["DEDUP_MIN_CHUNK_KB"] * 1024,
+            max_size=config["DEDUP_MAX_CHUNK_KB"] * 1024,
+            uploads=config["STREAM_MAX_PENDING_PARTS"],
+        )
+    except Exception as e:
+        err_msg = f"Upload failed: {str(e)}"
+        log_backup("FAILED", filename, 0, err_msg)
+        return False, err_msg
+
+    indexer = PlainDumpIndexer()
+    try:
+        stream_dump(["pg_dump", config["DATABASE_URL"]], writer, get_codec("none").compressor(), on_chunk=indexer.feed)
+        writer.close()
+        write_recipe(s3, config["R2_BUCKET_NAME"], filename, writer)
+        manifest = new_manifest(
+            filename,
+            FORMAT_DEDUP,
+            codec.name,
+            size=writer.uploaded_bytes,
+            sha256=writer.sha256.hexdigest(),
+            raw_size=writer.raw_bytes,
+            chunks=len(writer.chunks),
+            new_chunks=writer.new_chunks,
+            tables=indexer.tables,
+        )
+        write_manifest(s3, config["R2_BUCKET_NAME"], filename, manifest)
+    except subprocess.CalledProcessError as e:
+        writer.abort()
+        err_msg = f"Dump failed: {e.stderr.decode()}"
+        log_backup("FAILED", filename, 0, err_msg)
+        return False, err_msg
+    except Exception as e:
+        writer.abort()
+        err_msg = f"Upload failed: {str(e)}"
+        log_backup("FAILED", filename, 0, err_msg)
+        return False, err_msg
+
+    raw_mb = round(writer.raw_bytes/(1024*1024), 2)
+    _catalog_add(s3, config, filename, writer.uploaded_bytes)
+    log_backup("SUCCESS", filename, writer.uploaded_bytes, f"Dedup backup uploaded successfully ({raw_mb} MB dump, {writer.new_chunks} of {len(writer.chunks)} chunks new)")
+    return True, f"Backup successful ({round(writer.uploaded_bytes/(1024*1024), 2)} MB uploaded for {raw_mb} MB dump)"
+
+def perform_directory_backup():
+    """
+    Runs a parallel directory-format dump (BACKUP_JOBS workers) and uploads each
+    per-table file under a `backup_<ts>.dir/` prefix as soon as it is written.
+    Returns: (success: bool, message: str)
+    """
+    config = get_config()
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    filename = _backup_key(config, f"backup_{timestamp}.dir")
+
+    print(f"Starting parallel backup: {filename} ({config['BACKUP_JOBS']} jobs)")
+
+    try:
+        validate_config(config, ["DATABASE_URL", "R2_ENDPOINT_URL", "R2_ACCESS_KEY_ID", "R2_SECRET_ACCESS_KEY", "R2_BUCKET_NAME"])
+        s3 = get_s3_client()
+        manifest = dump_directory(
+            config["DATABASE_URL"],
+            s3,
+            config["R2_BUCKET_NAME"],
+            filename,
+            jobs=config["BACKUP_JOBS"],
+            table_stats=_collect_table_stats(),
+        )
+    except subprocess.CalledProcessError as e:
+        err_msg = f"Dump failed: {e.stderr.decode()}"
+        log_backup("FAILED", filename, 0, err_msg)
+        return False, err_msg
+    except Exception as e:
+        err_msg = f"Upload failed: {str(e)}"
+        log_backup("FAILED", filename, 0, err_msg)
+        return False, err_msg
+
+    total_size = sum(f["size"] for f in manifest["files"])
+    _catalog_add(s3, config, filename, total_size)
+    log_backup("SUCCESS", filename, total_size, f"Parallel backup uploaded successfully ({len(manifest['files'])} files)")
+    return True, f"Backup successful ({round(total_size/(1024*1024), 2)} MB)"
+
+def perform_copy_backup(copy_format="text", filename=None):
+    """
+    Exports every table from one exported snapshot with BACKUP_JOBS parallel COPY workers,
+    splitting large tables into EXPORT_CHUNK_ROWS primary-key ranges stored as separate
+    objects under a `backup_<ts>.copy/` prefix.
+    `copy_format="binary"` stores COPY (FORMAT binary) output, which skips text encoding
+    and parsing on both ends; it restores only into the same PostgreSQL major version.
+    With EXPORT_REUSE_UNCHANGED, tables whose fingerprint matches the previous COPY backup
+    reuse its objects, so the work done scales with what changed.
+    Returns: (success: bool, message: str)
+    """
+    config = get_config()
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    filename = filename or _backup_key(config, f"backup_{timestamp}.copy")
+
+    print(f"Starting snapshot COPY backup: {filename} ({copy_format}, {config['BACKUP_JOBS']} workers)")
+
+    try:
+        validate_config(config, ["DATABASE_URL", "R2_ENDPOINT_URL", "R2_ACCESS_KEY_ID", "R2_SECRET_ACCESS_KEY", "R2_BUCKET_NAME"])
+        codec = get_codec(config["BACKUP_CODEC"])
+        s3 = get_s3_client()
+        # Unchanged tables point at the previous full COPY backup's objects instead of being exported again.
+        previous = None
+        if config["EXPORT_REUSE_UNCHANGED"] and get_state("last_copy_backup"):
+            previous = load_manifest(s3, config["R2_BUCKET_NAME"], get_state("last_copy_backup"))
+        manifest = export_snapshot_backup(
+            config["DATABASE_URL"],
+            s3,
+            config["R2_BUCKET_NAME"],
+            filename,
+            codec,
+            level=config["BACKUP_COMPRESSION_LEVEL"],
+            workers=config["BACKUP_JOBS"],
+            chunk_rows=config["EXPORT_CHUNK_ROWS"],
+            copy_format=copy_format,
+            previous=previous,
+            hash_max_rows=config["FINGERPRINT_HASH_MAX_ROWS"],
+        )
+    except subprocess.CalledProcessError as e:
+        err_msg = f"Dump failed: {e.stderr.decode()}"
+        log_backup("FAILED", filename, 0, err_msg)
+        return False, err_msg
+    except Exception as e:
+        err_msg = f"Export failed: {str(e)}"
+        log_backup("FAILED", filename, 0, err_msg)
+        return False, err_msg
+
+    set_state("last_copy_backup", filename)
+    chunks = [c for t in manifest["tables"].values() for c in t["chunks"]]
+    uploaded = manifest["uploaded_bytes"]
+    _catalog_add(s3, config, filename, uploaded)
+    log_backup("SUCCESS", filename, uploaded, f"Snapshot COPY backup ({copy_format}) uploaded successfully ({len(manifest['tables'])} tables, {len(chunks)} chunks, {len(manifest['reused_tables'])} unchanged tables reused)")
+    return True, f"Backup successful ({round(uploaded/(1024*1024), 2)} MB uploaded)"
+
+def perform_subset_backup(seeds=None, full_tables=None, child_depth=None):
+    """
+    Exports a referentially consistent slice of the database as a COPY backup
+    (`backup_<ts>_subset.copy/`), restorable like any other. Starting from `seeds`
+    (default SUBSET_SEEDS, e.g. [{"table": "invoice", "where": "created_at > now() - interval '30 days'"},
+    {"table": "agent", "order_by": "id", "limit": 50}]) and every row of `full_tables`, it pulls in
+    the seed rows' children for `child_depth` levels and then every row they reference,
+    following the foreign keys and `linked_*` -> bubble_id references in schema_metadata.json.
+    The subset is computed and exported from one snapshot; the full schema is included.
+    Seeds are run as SQL on the production database, so they must come from configuration.
+    Returns: (success: bool, message: str)
+    """
+    config = get_config()
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    filename = _backup_key(config, f"backup_{timestamp}{SUBSET_SUFFIX}")
+    print(f"Starting subset backup: {filename}")
+
+    try:
+        validate_config(config, ["DATABASE_URL", "R2_ENDPOINT_URL", "R2_ACCESS_KEY_ID", "R2_SECRET_ACCESS_KEY", "R2_BUCKET_NAME"])
+        seeds = json.loads(config["SUBSET_SEEDS"]) if seeds is None else seeds
+        full_tables = config["SUBSET_FULL_TABLES"] if full_tables is None else full_tables
+        child_depth = config["SUBSET_CHILD_DEPTH"] if child_depth is None else child_depth
+        if not seeds and not full_tables:
+            return False, "No subset seeds: set SUBSET_SEEDS or pass seeds"
+        relations, unresolved = load_relations(config["SCHEMA_METADATA_PATH"], json.loads(config["SUBSET_LINK_TARGETS"]))
+        if unresolved:
+            print(f"Subset: no target table for {', '.join(unresolved)}; set SUBSET_LINK_TARGETS to follow them")
+        codec = get_codec(config["BACKUP_CODEC"])
+        s3 = get_s3_client()
+        table_filter = subset_filter(relations, seeds, full_tables, child_depth)
+        manifest = export_snapshot_backup(
+            config["DATABASE_URL"],
+            s3,
+            config["R2_BUCKET_NAME"],
+            filename,
+            codec,
+            level=config["BACKUP_COMPRESSION_LEVEL"],
+            workers=config["BACKUP_JOBS"],
+            table_filter=table_filter,
+            manifest_fields={"subset": {"seeds": seeds, "full_tables": full_tables, "child_depth": child_depth, "unresolved_links": unresolved}},
+        )
+        # The ctid lists only mean something inside the export snapshot; keep the manifest small.
+        for table in manifest["tables"].values():
+            if table["filter"]:
+                table["filter"] = "subset"
+        write_manifest(s3, config["R2_BUCKET_NAME"], filename, manifest)
+    except subprocess.CalledProcessError as e:
+        err_msg = f"Dump failed: {e.stderr.decode()}"
+        log_backup("FAILED", filename, 0, err_msg)
+        return False, err_msg
+    except Exception as e:
+        err_msg = f"Subset backup failed: {str(e)}"
+        print(err_msg)
+        log_backup("FAILED", filename, 0, err_msg)
+        return False, err_msg
+
+    rows = sum(t["rows"] for t in manifest["tables"].values())
+    tables = sum(1 for t in manifest["tables"].values() if t["rows"])
+    _catalog_add(s3, config, filename, manifest["size"])
+    log_backup("SUCCESS", filename, manifest["size"], f"Subset backup uploaded successfully ({rows} rows from {tables} tables)")
+    return True, f"Subset backup successful ({round(manifest['size']/(1024*1024), 2)} MB, {rows} rows from {tables} tables)"
+
+def perform_incremental_backup():
+    """
+    Exports only rows changed since the previous backup in the chain, judged by each
+    table's updated_at / modified_date / synced_at / last_synced_at columns,
+    to a `backup_<ts>_incr.copy/` prefix whose manifest links to its parent and base.
+    Starts a new chain with a full COPY backup when there is none, after
+    INCREMENTAL_FULL_EVERY deltas, or when the schema changed. Tables with no change
+    column or primary key are exported in full every time, as are rows whose change
+    columns are all NULL; deleted rows, and updates that do not move a change column,
+    are not captured until the next full backup.
+    Returns: (success: bool, message: str)
+    """
+    config = get_config()
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    bucket = config["R2_BUCKET_NAME"]
+
+    try:
+        chain = get_state("incremental_chain")
+        validate_config(config, ["DATABASE_URL", "R2_ENDPOINT_URL", "R2_ACCESS_KEY_ID", "R2_SECRET_ACCESS_KEY", "R2_BUCKET_NAME"])
+        s3 = get_s3_client()
+        need_full = not chain or chain["count"] >= config["INCREMENTAL_FULL_EVERY"]
+        if not need_full:
+            base = load_manifest(s3, bucket, chain["base"])
+            conn = psycopg2.connect(config["DATABASE_URL"])
+            try:
+                need_full = base is None or not schema_matches(conn.cursor(), base)
+            finally:
+                conn.close()
+    except Exception as e:
+        err_msg = f"Incremental backup failed: {str(e)}"
+        log_backup("FAILED", _backup_key(config, f"backup_{timestamp}_incr.copy"), 0, err_msg)
+        return False, err_msg
+
+    if need_full:
+        filename = _backup_key(config, f"backup_{timestamp}.copy")
+        success, message = perform_copy_backup(filename=filename)
+        if success:
+            manifest = load_manifest(s3, bucket, filename)
+            set_state("incremental_chain", {"base": filename, "last": filename, "watermark": manifest["snapshot_time"], "count": 0})
+        return success, message
+
+    filename = _backup_key(config, f"backup_{timestamp}_incr.copy")
+    print(f"Starting incremental backup: {filename} (changes since {chain['watermark']})")
+    try:
+        codec = get_codec(config["BACKUP_CODEC"])
+        manifest = export_snapshot_backup(
+            config["DATABASE_URL"],
+            s3,
+            bucket,
+            filename,
+            codec,
+            level=config["BACKUP_COMPRESSION_LEVEL"],
+            workers=config["BACKUP_JOBS"],
+            chunk_rows=config["EXPORT_CHUNK_ROWS"],
+            table_filter=change_filter(chain["watermark"], config["INCREMENTAL_OVERLAP_MINUTES"]),
+            include_schema=False,
+            manifest_fields={"base": chain["base"], "parent": chain["last"], "since": chain["watermark"]},
+        )
+    except subprocess.CalledProcessError as e:
+        err_msg = f"Dump failed: {e.stderr.decode()}"
+        log_backup("FAILED", filename, 0, err_msg)
+        return False, err_msg
+    except Exception as e:
+        err_msg = f"Export failed: {str(e)}"
+        log_backup("FAILED", filename, 0, err_msg)
+        return False, err_msg
+
+    set_state("incremental_chain", dict(chain, last=filename, watermark=manifest["snapshot_time"], count=chain["count"] + 1))
+    rows = sum(t["rows"] for t in manifest["tables"].values())
+    full_tables = sum(1 for t in manifest["tables"].values() if not t["filter"])
+    _catalog_add(s3, config, filename, manifest["size"])
+    log_backup("SUCCESS", filename, manifest["size"], f"Incremental backup uploaded successfully ({rows} rows, {full_tables} tables exported in full, parent {chain['last']})")
+    return True, f"Incremental backup successful ({round(manifest['size']/(1024*1024), 2)} MB, {rows} rows)"
+
+# One catalog round trip: WAL position plus write counters of the application's tables.
+# The service's own _admin_ tables are excluded, since logging a backup writes to them.
+CHANGE_STATE_QUERY = r"""
+    SELECT pg_current_wal_lsn()::text,
+           (SELECT stats_reset FROM pg_stat_database WHERE datname = current_database()),
+           count(*),
+           coalesce(sum(s.n_tup_ins + s.n_tup_upd + s.n_tup_del), 0),
+           coalesce(sum(c.relfilenode::bigint), 0)
+    FROM pg_stat_user_tables s
+    JOIN pg_class c ON c.oid = s.relid
+    WHERE s.relname NOT LIKE '\_admin\_%'
+"""
+
+def _lsn_bytes(lsn):
+    high, _, low = lsn.partition("/")
+    return (int(high, 16) << 32) + int(low, 16)
+
+def database_change_state():
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute(CHANGE_STATE_QUERY)
+        lsn, stats_reset, tables, row_changes, relfilenodes = cur.fetchone()
+    finally:
+        conn.close()
+    return {
+        "lsn": lsn,
+        "stats_reset": stats_reset.isoformat() if stats_reset else None,
+        "tables": tables,
+        "row_changes": int(row_changes),
+        "relfilenodes": int(relfilenodes),
+    }
+
+def perform_scheduled_backup():
+    """
+    Runs the scheduled backup unless nothing changed since the last successful one.
+
+    Compares the WAL position and the application tables' insert/update/delete counters
+    (plus table count and relfilenodes, which catch DDL and rewrites) with the values
+    recorded when the last scheduled backup started. With no row changes the run is
+    skipped; with at most DOWNGRADE_MAX_ROW_CHANGES it runs DOWNGRADE_MODE instead.
+    WAL written by autovacuum, checkpoints or this service alone does not trigger a backup.
+    Returns: (success: bool, message: str)
+    """
+    config = get_config()
+    if not config["SKIP_UNCHANGED_BACKUPS"]:
+        return perform_backup()
+
+    try:
+        current = database_change_state()
+        last = get_state("last_backup_change_state")
+    except Exception as e:
+        print(f"Change check failed, backing up anyway: {e}")
+        return perform_backup()
+
+    mode = None
+    if last and last["stats_reset"] == current["stats_reset"]:
+        wal_bytes = _lsn_bytes(current["lsn"]) - _lsn_bytes(last["lsn"])
+        row_changes = current["row_changes"] - last["row_changes"]
+        same_tables = (last["tables"], last["relfilenodes"]) == (current["tables"], current["relfilenodes"])
+        if same_tables and row_changes == 0:
+            message = f"No changes since last backup ({wal_bytes} bytes of WAL, no row changes); skipped"
+            print(message)
+            return True, message
+        if same_tables and row_changes <= config["DOWNGRADE_MAX_ROW_CHANGES"]:
+            print(f"Only {row_changes} row changes since last backup; running {config['DOWNGRADE_MODE']} backup")
+            mode = config["DOWNGRADE_MODE"]
+
+    success, message = perform_backup(mode)
+    if success:
+        set_state("last_backup_change_state", current)
+    return success, message
+
+def perform_retention(dry_run=False):
+    """
+    Prunes backups by grandfather-father-son retention (RETENTION_KEEP_HOURLY/DAILY/WEEKLY/MONTHLY),
+    working from the catalog instead of listing the bucket. Subset backups are not full
+    backups and only count against RETENTION_KEEP_SUBSETS (the newest N are kept).
+    Point-in-time base backups beyond the newest RETENTION_KEEP_BASEBACKUPS are pruned,
+    along with the WAL older than the oldest kept one (see plan_archive_retention). Backups that a kept incremental or
+    chunk-reusing COPY backup reads from, and the ones the next incremental/COPY backup will
+    build on, are kept. Objects go in batched delete_objects calls; each pruned backup is
+    logged as PRUNED. Dedup chunks no longer used by any recipe left in the bucket are removed last.
+    Returns: (success: bool, message: str)
+    """
+    config = get_config()
+    validate_config(config, ["R2_ENDPOINT_URL", "R2_ACCESS_KEY_ID", "R2_SECRET_ACCESS_KEY", "R2_BUCKET_NAME"])
+    s3 = get_s3_client()
+    bucket = config["R2_BUCKET_NAME"]
+    keep = {
+        "hourly": config["RETENTION_KEEP_HOURLY"],
+        "daily": config["RETENTION_KEEP_DAILY"],
+        "weekly": config["RETENTION_KEEP_WEEKLY"],
+        "monthly": config["RETENTION_KEEP_MONTHLY"],
+        "subsets": config["RETENTION_KEEP_SUBSETS"],
+    }
+    started = datetime.datetime.now(datetime.timezone.utc)
+    try:
+        backups = read_catalog(s3, bucket)
+        if backups is None:
+            backups = rebuild_catalog(s3, bucket)
+        chain = get_state("incremental_chain") or {}
+        protected = [name for name in (chain.get("base"), chain.get("last"), get_state("last_copy_backup")) if name]
+        retained, expired = plan_retention(s3, bucket, list(backups.values()), keep, protected)
+        base_keys, wal_keys = plan_archive_retention(s3, bucket, config["RETENTION_KEEP_BASEBACKUPS"])
+        if dry_run:
+            return True, (
+                f"Retention would prune {len(expired)} of {len(backups)} backups: {', '.join(e['filename'] for e in expired) or 'none'}; "
+                f"{len(base_keys) // 2} base backups and {len(wal_keys)} WAL objects"
+            )
+
+        keys = []
+        for entry in expired:
+            keys.extend(backup_objects(s3, bucket, entry["filename"]))
+        # Drop them from the catalog first, so nothing offers a half-deleted backup for restore.
+        update_catalog(s3, bucket, remove=[entry["filename"] for entry in expired])
+        failed = delete_keys(s3, bucket, keys)
+        for entry in expired:
+            log_backup("PRUNED", entry["filename"], entry["size"], "Removed by retention policy")
+
+        failed += delete_keys(s3, bucket, base_keys)
+        failed += delete_keys(s3, bucket, wal_keys)
+
+        with _chunk_store_lock:
+            chunks = unreferenced_chunks(s3, bucket, started)
+            failed += delete_keys(s3, bucket, chunks)
+
+        message = (
+            f"Retention pruned {len(expired)} backups ({len(keys)} objects), {len(base_keys) // 2} base backups, "
+            f"{len(wal_keys)} WAL objects and {len(chunks)} unused chunks, kept {len(retained)}"
+        )
+        if failed:
+            message += f"; {len(failed)} objects could not be deleted"
+        print(message)
+        return not failed, message
+    except Exception as e:
+        err_msg = f"Retention failed: {str(e)}"
+        print(err_msg)
+        log_backup("FAILED", "retention", 0, err_msg)
+        return False, err_msg
+
+_wal_archiver = None
+
+def start_wal_archiving():
+    """Starts the background WAL archiver when WAL_ARCHIVE_ENABLED=true. Returns the archiver or None."""
+    global _wal_archiver
+    config = get_config()
+    if not config["WAL_ARCHIVE_ENABLED"] or _wal_archiver is not None:
+        return _wal_archiver
+    validate_config(config, ["DATABASE_URL", "R2_ENDPOINT_URL", "R2_ACCESS_KEY_ID", "R2_SECRET_ACCESS_KEY", "R2_BUCKET_NAME"])
+    s3 = get_s3_client()
+    archiver = WalArchiver(
+        config["DATABASE_URL"],
+        s3,
+        config["R2_BUCKET_NAME"],
+        config["WAL_SPOOL_DIR"],
+        get_codec(config["BACKUP_CODEC"]),
+        level=config["BACKUP_COMPRESSION_LEVEL"],
+        slot=config["WAL_SLOT_NAME"],
+        batch_segments=config["WAL_BATCH_SEGMENTS"],
+        batch_seconds=config["WAL_BATCH_SECONDS"],
+    )
+    archiver.start()
+    _wal_archiver = archiver
+    print(f"WAL archiving started (slot {config['WAL_SLOT_NAME']}, batches every {config['WAL_BATCH_SECONDS']}s)")
+    return archiver
+
+def stop_wal_archiving():
+    global _wal_archiver
+    if _wal_archiver is not None:
+        _wal_archiver.stop()
+        _wal_archiver = None
+
+def release_wal_slot():
+    """
+    Drops WAL_SLOT_NAME while WAL archiving is disabled, so production does not keep WAL
+    for an archiver that is no longer running. Archiving starts a fresh slot when re-enabled.
+    """
+    config = get_config()
+    if config["WAL_ARCHIVE_ENABLED"] or not config["DATABASE_URL"]:
+        return
+    if drop_slot(config["DATABASE_URL"], config["WAL_SLOT_NAME"]):
+        print(f"WAL archiving is disabled; dropped replication slot {config['WAL_SLOT_NAME']}")
+
+def get_pitr_unavailable():
+    """Why point-in-time restore cannot run in this deployment, or None."""
+    return pitr_unavailable(get_config()["PG_BIN_DIR"])
+
+def perform_base_backup():
+    """
+    Takes a pg_basebackup of the cluster for point-in-time restore, streamed to
+    `basebackups/` in R2. Only useful while WAL archiving is running.
+    Returns: (success: bool, message: str)
+    """
+    config = get_config()
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    name = f"base_{timestamp}"
+    print(f"Starting base backup: {name}")
+
+    try:
+        validate_config(config, ["DATABASE_URL", "R2_ENDPOINT_URL", "R2_ACCESS_KEY_ID", "R2_SECRET_ACCESS_KEY", "R2_BUCKET_NAME"])
+        s3 = get_s3_client()
+        manifest = base_backup(
+            config["DATABASE_URL"],
+            s3,
+            config["R2_BUCKET_NAME"],
+            name,
+            get_codec(config["BACKUP_CODEC"]),
+            level=config["BACKUP_COMPRESSION_LEVEL"],
+            part_size=config["STREAM_PART_SIZE_MB"] * MB,
+        )
+    except subprocess.CalledProcessError as e:
+        err_msg = f"Base backup failed: {e.stderr.decode()}"
+        log_backup("FAILED", name, 0, err_msg)
+        return False, err_msg
+    except Exception as e:
+        err_msg = f"Base backup failed: {str(e)}"
+        log_backup("FAILED", name, 0, err_msg)
+        return False, err_msg
+
+    log_backup("SUCCESS", manifest["backup"], manifest["size"], f"Base backup uploaded successfully (WAL from {manifest['start_segment']})")
+    return True, f"Base backup successful ({round(manifest['size']/(1024*1024), 2)} MB)"
+
+def perform_backup(mode=None):
     """
     Dumps the database to a file, uploads to R2, and cleans up.
+    `mode` (default: BACKUP_MODE) selects "file", "custom", "stream", "directory", "copy", "binary",
+    "incremental", "dedup" or "subset".
+    "custom" writes a pg_dump custom-format archive, which restores in parallel.
     Returns: (success: bool, message: str)
     """
     config = get_config()
+    mode = mode or config["BACKUP_MODE"]
+    if mode == "stream":
+        return perform_stream_backup()
+    if mode == "directory":
+        return perform_directory_backup()
+    if mode == "copy":
+        return perform_copy_backup()
+    if mode == "binary":
+        return perform_copy_backup(copy_format="binary")
+    if mode == "incremental":
+        return perform_incremental_backup()
+    if mode == "dedup":
+        return perform_dedup_backup()
+    if mode == "subset":
+        return perform_subset_backup()
+    _resume_pending_uploads(config)
     timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-    filename = f"backup_{timestamp}.sql"
-    filepath = f"/tmp/{filename}"
+    if mode == "custom":
+        fmt, filename, dump_args = FORMAT_CUSTOM, f"backup_{timestamp}.dump", "-Fc "
+    else:
+        fmt, filename, dump_args = FORMAT_PLAIN, f"backup_{timestamp}.sql", ""
+    filepath = dump_path = f"/tmp/{filename}"
+    filename = _backup_key(config, filename)
     
     print(f"Starting backup: {filename}")
 
     # 1. Dump Database
     try:
         # Use pg_dump with the full URL
-        command = f"pg_dump '{config['DATABASE_URL']}' -f {filepath}"
+        command = f"pg_dump '{config['DATABASE_URL']}' {dump_args}-f {filepath}"
         process = subprocess.run(command, shell=True, check=True, capture_output=True)
     except subprocess.CalledProcessError as e:
         err_msg = f"Dump failed: {e.stderr.decode()}"
@@ -200,19 +1383,32 @@ def perform_backup():
     try:
         validate_config(config, ["R2_ENDPOINT_URL", "R2_ACCESS_KEY_ID", "R2_SECRET_ACCESS_KEY", "R2_BUCKET_NAME"])
         
-        s3 = boto3.client(
-            's3',
-            endpoint_url=config["R2_ENDPOINT_URL"],
-            aws_access_key_id=config["R2_ACCESS_KEY_ID"],
-            aws_secret_access_key=config["R2_SECRET_ACCESS_KEY"]
-        )
+        s3 = get_s3_client()
         
-        with open(filepath, "rb") as f:
-            s3.upload_fileobj(f, config["R2_BUCKET_NAME"], filename)
+        # Custom archives are already compressed by pg_dump itself.
+        codec = get_codec(config["BACKUP_CODEC"] if fmt == FORMAT_PLAIN else "none")
+        compression = None
+        if codec.name == "none":
+            file_size = _resumable_upload(s3, config, filename, filepath, {"backup-format": fmt}).upload()
+            _write_file_manifest(s3, config, filename, filepath, fmt)
+        else:
+            # Compress to a file first, so the upload can run parts in parallel and resume.
+            filename += codec.extension
+            filepath = dump_path + codec.extension
+            compressor = MeasuredCompressor(_backup_compressor(config, codec))
+            indexer = PlainDumpIndexer()
+            with open(filepath, "wb") as f:
+                for chunk in read_file_chunks(dump_path):
+                    indexer.feed(chunk)
+                    f.write(compressor.compress(chunk))
+                f.write(compressor.flush())
+            os.remove(dump_path)
+            file_size = _resumable_upload(s3, config, filename, filepath, {"backup-format": fmt, "codec": codec.name}).upload()
+            compression = (codec.name, compressor)
+            _write_plain_manifest(s3, config, filename, codec, file_size, file_sha256(filepath), indexer, compressor)
 
-        
-        file_size = os.path.getsize(filepath)
-        log_backup("SUCCESS", filename, file_size, "Backup uploaded successfully")
+        _catalog_add(s3, config, filename, file_size)
+        log_backup("SUCCESS", filename, file_size, "Backup uploaded successfully", compression=compression)
         
         # Cleanup
         os.remove(filepath)
@@ -220,5 +1416,12 @@ def perform_backup():
         
     except Exception as e:
         err_msg = f"Upload failed: {str(e)}"
+        # Keep the dump while a checkpoint exists, so the next run resumes the upload.
+        if os.path.exists(filepath + CHECKPOINT_SUFFIX):
+            err_msg += " (checkpoint kept; the next backup will resume this upload)"
+        elif os.path.exists(filepath):
+            os.remove(filepath)
+        if dump_path != filepath and os.path.exists(dump_path):
+            os.remove(dump_path)
         log_backup("FAILED", filename, 0, err_msg)
         return False, err_msg
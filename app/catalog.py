@@ -0,0 +1,179 @@
+import datetime
+import json
+import os
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+from .dedup import CHUNK_PREFIX
+from .manifest import load_manifest, MANIFEST_SUFFIX, PREFIX_FORMATS
+from .wal import WAL_PREFIX, BASE_PREFIX
+
+CATALOG_KEY = "catalog.json"
+CATALOG_VERSION = 1
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Objects that are not restorable backups on their own.
+INTERNAL_PREFIXES = (WAL_PREFIX, BASE_PREFIX, CHUNK_PREFIX)
+
+_write_lock = threading.Lock()
+_caches = {}
+
+
+def catalog_entry(filename, size, last_modified=None):
+    last_modified = last_modified or datetime.datetime.now()
+    return {"filename": filename, "size": size, "last_modified": last_modified.strftime(TIME_FORMAT)}
+
+
+def _prefix_backup(s3, bucket, name):
+    """Catalog entry for a directory/COPY backup, from its manifest; None while it is still uploading."""
+    manifest = load_manifest(s3, bucket, name)
+    if manifest is None:
+        return None
+    created = datetime.datetime.strptime(manifest["created_at"], "%Y-%m-%dT%H:%M:%SZ")
+    return catalog_entry(name, manifest.get("size", 0), created)
+
+
+def walk_backups(s3, bucket, prefix=""):
+    """
+    Lists the backups under `prefix` with delimiter listing: one request per "directory"
+    page, never descending into WAL, chunk-store or multi-object backup prefixes, so the
+    cost follows the number of backups rather than the number of objects.
+    """
+    backups = {}
+    pending = [prefix]
+    while pending:
+        current = pending.pop()
+        for page in s3.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=current, Delimiter="/"):
+            for obj in page.get("Contents", []):
+                key = obj["Key"]
+                if key != CATALOG_KEY and not key.endswith(MANIFEST_SUFFIX):
+                    backups[key] = catalog_entry(key, obj["Size"], obj["LastModified"])
+            for common in page.get("CommonPrefixes", []):
+                sub = common["Prefix"]
+                if sub.startswith(INTERNAL_PREFIXES):
+                    continue
+                name = sub.rstrip("/")
+                if os.path.splitext(name)[1] in PREFIX_FORMATS:
+                    entry = _prefix_backup(s3, bucket, name)
+                    if entry:
+                        backups[name] = entry
+                else:
+                    pending.append(sub)
+    return backups
+
+
+def scan_backups(s3, bucket):
+    """
+    Lists every backup in the bucket. Used to build the catalog when it is missing;
+    the catalog is read otherwise.
+    """
+    return walk_backups(s3, bucket)
+
+
+def read_catalog(s3, bucket):
+    """The catalog's backups (filename -> entry), or None if there is no catalog yet."""
+    try:
+        body = s3.get_object(Bucket=bucket, Key=CATALOG_KEY)["Body"].read()
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+            return None
+        raise
+    return json.loads(body)["backups"]
+
+
+def write_catalog(s3, bucket, backups):
+    body = {"version": CATALOG_VERSION, "updated_at": datetime.datetime.now().strftime(TIME_FORMAT), "backups": backups}
+    s3.put_object(Bucket=bucket, Key=CATALOG_KEY, Body=json.dumps(body).encode(), ContentType="application/json")
+    _cache(s3, bucket).set(backups)
+
+
+def rebuild_catalog(s3, bucket):
+    """Full reconciliation: rescans the bucket and rewrites the catalog."""
+    with _write_lock:
+        backups = scan_backups(s3, bucket)
+        write_catalog(s3, bucket, backups)
+    return backups
+
+
+def update_catalog(s3, bucket, add=(), remove=()):
+    """
+    Adds entries (see catalog_entry) and removes filenames. The catalog has a single writer,
+    this service, so a read-modify-write under a process lock is enough.
+    """
+    with _write_lock:
+        backups = read_catalog(s3, bucket)
+        if backups is None:
+            backups = scan_backups(s3, bucket)
+        for entry in add:
+            backups[entry["filename"]] = entry
+        for filename in remove:
+            backups.pop(filename, None)
+        write_catalog(s3, bucket, backups)
+    return backups
+
+
+def sorted_backups(backups):
+    return sorted(backups.values(), key=lambda b: b["last_modified"], reverse=True)
+
+
+class CatalogCache:
+    """
+    Keeps the catalog in memory for `ttl` seconds. Once stale, callers still get the cached
+    copy immediately while one background thread reloads it, so a page load never waits
+    on R2 except the very first one.
+    """
+
+    def __init__(self, loader, ttl=60):
+        self._loader = loader
+        self.ttl = ttl
+        self._backups = None
+        self._loaded_at = 0.0
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            backups, stale = self._backups, time.monotonic() - self._loaded_at > self.ttl
+            if backups is not None and stale and not self._refreshing:
+                self._refreshing = True
+                threading.Thread(target=self._refresh_in_background, daemon=True).start()
+        if backups is None:
+            backups = self.refresh()
+        return backups
+
+    def refresh(self):
+        backups = self._loader()
+        self.set(backups)
+        return backups
+
+    def set(self, backups):
+        with self._lock:
+            self._backups = backups
+            self._loaded_at = time.monotonic()
+
+    def _refresh_in_background(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            print(f"Catalog refresh failed: {e}")
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+
+def _cache(s3, bucket, ttl=60):
+    cache = _caches.get(bucket)
+    if cache is None:
+        def load():
+            backups = read_catalog(s3, bucket)
+            return rebuild_catalog(s3, bucket) if backups is None else backups
+        cache = _caches.setdefault(bucket, CatalogCache(load, ttl))
+    cache.ttl = ttl
+    return cache
+
+
+def cached_backups(s3, bucket, ttl=60):
+    """Backups from the in-process catalog cache, newest first."""
+    return sorted_backups(_cache(s3, bucket, ttl).get())
@@ -0,0 +1,231 @@
+import os
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+class _Passthrough:
+    def compress(self, data):
+        return data
+
+    def decompress(self, data):
+        return data
+
+    def flush(self):
+        return b""
+
+
+class _MultiFrameDecompressor:
+    """
+    Wraps a one-frame decoder factory so that streams made of several concatenated
+    frames (as produced by block-parallel compression) decode as one stream.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._decoder = factory()
+
+    def decompress(self, data):
+        out = []
+        while data:
+            out.append(self._decoder.decompress(data))
+            if not self._decoder.eof:
+                break
+            data = self._decoder.unused_data
+            self._decoder = self._factory()
+        return b"".join(out)
+
+    def flush(self):
+        return b""
+
+
+class _Lz4Compressor:
+    def __init__(self, level):
+        self._compressor = lz4.frame.LZ4FrameCompressor(compression_level=level)
+        self._header = self._compressor.begin()
+
+    def compress(self, data):
+        out = self._header + self._compressor.compress(data)
+        self._header = b""
+        return out
+
+    def flush(self):
+        return self._header + self._compressor.flush()
+
+
+class Codec:
+    """A compression format: file extension, default level and streaming (de)compressors."""
+
+    def __init__(self, name, extension, default_level, compressor, decompressor, available=True):
+        self.name = name
+        self.extension = extension
+        self.default_level = default_level
+        self.available = available
+        self._compressor = compressor
+        self._decompressor = decompressor
+
+    def compressor(self, level=None):
+        return self._compressor(self.default_level if level is None else level)
+
+    def decompressor(self):
+        return self._decompressor()
+
+    def compress(self, data, level=None):
+        """One-shot compression of `data` into a complete, standalone frame."""
+        compressor = self.compressor(level)
+        return compressor.compress(data) + compressor.flush()
+
+
+CODECS = {
+    "none": Codec("none", "", 0, lambda level: _Passthrough(), _Passthrough),
+    "gzip": Codec(
+        "gzip", ".gz", 6,
+        lambda level: zlib.compressobj(level, zlib.DEFLATED, 31),
+        lambda: _MultiFrameDecompressor(lambda: zlib.decompressobj(31)),
+    ),
+    "zstd": Codec(
+        "zstd", ".zst", 3,
+        lambda level: zstandard.ZstdCompressor(level=level).compressobj(),
+        lambda: _MultiFrameDecompressor(lambda: zstandard.ZstdDecompressor().decompressobj()),
+        available=zstandard is not None,
+    ),
+    "lz4": Codec(
+        "lz4", ".lz4", 0,
+        _Lz4Compressor,
+        lambda: _MultiFrameDecompressor(lz4.frame.LZ4FrameDecompressor),
+        available=lz4 is not None,
+    ),
+}
+
+
+class ParallelCompressor:
+    """
+    Splits the stream into fixed-size blocks and compresses them on a thread pool.
+
+    Each block becomes a complete gzip member / zstd / lz4 frame, and concatenated
+    frames are a valid stream for the standard tools (gunzip, zstd -d, lz4 -d).
+    zlib, zstandard and lz4 release the GIL while compressing, so this scales with cores.
+    At most 2 * threads blocks are in flight, which bounds memory.
+    `blocks` records [raw_offset, raw_length, offset, length] for every emitted block, so a
+    reader can later fetch and decompress just the blocks covering a raw byte range.
+    """
+
+    def __init__(self, codec, level=None, threads=None, block_size=4 * 1024 * 1024):
+        self.codec = codec
+        self.level = level
+        self.threads = threads or os.cpu_count() or 1
+        self.block_size = block_size
+        self._buffer = bytearray()
+        self._pending = deque()
+        self._pool = ThreadPoolExecutor(max_workers=self.threads)
+        self.blocks = []
+        self._raw_offset = 0
+        self._offset = 0
+
+    def compress(self, data):
+        self._buffer += data
+        while len(self._buffer) >= self.block_size:
+            block = bytes(self._buffer[:self.block_size])
+            del self._buffer[:self.block_size]
+            self._submit(block)
+        return self._collect(wait=len(self._pending) > 2 * self.threads)
+
+    def flush(self):
+        if self._buffer:
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+        try:
+            return self._collect(wait=True, drain=True)
+        finally:
+            self._pool.shutdown()
+
+    def _submit(self, block):
+        self._pending.append((len(block), self._pool.submit(self.codec.compress, block, self.level)))
+
+    def _collect(self, wait, drain=False):
+        """Returns finished blocks in stream order, blocking on the oldest one if `wait`."""
+        out = []
+        while self._pending and (self._pending[0][1].done() or wait):
+            raw_length, future = self._pending.popleft()
+            frame = future.result()
+            self.blocks.append([self._raw_offset, raw_length, self._offset, len(frame)])
+            self._raw_offset += raw_length
+            self._offset += len(frame)
+            out.append(frame)
+            wait = drain or len(self._pending) > 2 * self.threads
+        return b"".join(out)
+
+
+def build_compressor(codec, level=None, threads=1, block_size=4 * 1024 * 1024):
+    """Returns a streaming compressor for `codec`, block-parallel when `threads` > 1."""
+    if threads > 1 and codec.name != "none":
+        return ParallelCompressor(codec, level=level, threads=threads, block_size=block_size)
+    return codec.compressor(level)
+
+
+class MeasuredCompressor:
+    """Wraps a compressor to count bytes in/out and the time spent compressing."""
+
+    def __init__(self, compressor):
+        self._compressor = compressor
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.seconds = 0.0
+
+    def compress(self, data):
+        return self._measure(len(data), self._compressor.compress, data)
+
+    def flush(self):
+        return self._measure(0, self._compressor.flush)
+
+    def _measure(self, size, fn, *args):
+        started = time.perf_counter()
+        out = fn(*args)
+        self.seconds += time.perf_counter() - started
+        self.raw_bytes += size
+        self.compressed_bytes += len(out)
+        return out
+
+    @property
+    def blocks(self):
+        """Block map of a ParallelCompressor; empty for single-stream compressors."""
+        return getattr(self._compressor, "blocks", [])
+
+    @property
+    def ratio(self):
+        return round(self.raw_bytes / self.compressed_bytes, 2) if self.compressed_bytes else None
+
+    @property
+    def mb_per_second(self):
+        return round(self.raw_bytes / (1024 * 1024) / self.seconds, 1) if self.seconds else None
+
+
+def get_codec(name):
+    """Returns the codec called `name`, or raises ValueError if it is unknown or not installed."""
+    codec = CODECS.get(name or "none")
+    if codec is None:
+        raise ValueError(f"Unknown compression codec: {name} (choose from {', '.join(CODECS)})")
+    if not codec.available:
+        raise ValueError(f"Compression codec {name} is not installed")
+    return codec
+
+
+def codec_for_key(key, metadata=None):
+    """Detects the codec of a stored backup from its metadata, or its key suffix for older objects."""
+    if metadata and metadata.get("codec"):
+        return get_codec(metadata["codec"])
+    for codec in CODECS.values():
+        if codec.extension and key.endswith(codec.extension):
+            return get_codec(codec.name)
+    return CODECS["none"]
@@ -0,0 +1,179 @@
+import hashlib
+import json
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .manifest import FORMAT_DEDUP
+
+CHUNK_PREFIX = "chunks/"
+RECIPE_SUFFIX = ".dedup"
+# Bytes before a newline that decide whether it is a chunk boundary.
+WINDOW = 64
+
+
+def chunk_key(sha256, codec):
+    return f"{CHUNK_PREFIX}{sha256}{codec.extension}"
+
+
+class ContentChunker:
+    """
+    Splits a stream into content-defined chunks.
+
+    A chunk ends at a newline whose preceding WINDOW bytes hash (CRC-32) to zero under
+    `mask_bits`, so boundaries depend only on nearby content: an insertion early in the
+    dump shifts the bytes after it but the same boundaries are found again, and unchanged
+    tables come out as the same chunks. Newline anchoring keeps the hashing to one CRC per
+    line, which is fast enough in Python where a per-byte rolling hash is not; dump text is
+    line-oriented, and `max_size` forces a cut in long binary runs.
+    """
+
+    def __init__(self, min_size=256 * 1024, max_size=8 * 1024 * 1024, mask_bits=12):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.mask = (1 << mask_bits) - 1
+        self._buffer = bytearray()
+        self._scanned = 0
+
+    def feed(self, data):
+        """Adds `data` and returns the chunks it completed."""
+        self._buffer += data
+        chunks = []
+        while True:
+            cut = self._find_cut()
+            if cut is None:
+                return chunks
+            chunks.append(bytes(self._buffer[:cut]))
+            del self._buffer[:cut]
+            self._scanned = 0
+
+    def flush(self):
+        rest, self._buffer, self._scanned = bytes(self._buffer), bytearray(), 0
+        return [rest] if rest else []
+
+    def _find_cut(self):
+        buf = self._buffer
+        limit = min(len(buf), self.max_size)
+        pos = buf.find(b"\n", max(self.min_size, self._scanned, WINDOW), limit)
+        while pos >= 0:
+            if zlib.crc32(buf[pos - WINDOW:pos]) & self.mask == 0:
+                return pos + 1
+            pos = buf.find(b"\n", pos + 1, limit)
+        if len(buf) >= self.max_size:
+            return self.max_size
+        self._scanned = max(len(buf) - 1, 0)
+        return None
+
+
+class DedupWriter:
+    """
+    File-like sink (write/close) that chunks the stream with ContentChunker and stores
+    every chunk once, compressed, as `chunks/<sha256><ext>`. Chunks already in `known`
+    (keys present in the bucket) are only referenced. `chunks` is the backup's recipe:
+    [sha256, raw_length] in stream order.
+    """
+
+    def __init__(self, s3, bucket, codec, level=None, known=None, min_size=256 * 1024, max_size=8 * 1024 * 1024, uploads=4):
+        self.s3 = s3
+        self.bucket = bucket
+        self.codec = codec
+        self.level = level
+        self.known = set() if known is None else known
+        self.chunker = ContentChunker(min_size, max_size)
+        self.chunks = []
+        self.sha256 = hashlib.sha256()
+        self.raw_bytes = 0
+        self.new_chunks = 0
+        self.uploaded_bytes = 0
+        self._uploads = uploads
+        self._pool = ThreadPoolExecutor(max_workers=uploads)
+        self._pending = deque()
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.raw_bytes += len(data)
+        for chunk in self.chunker.feed(data):
+            self._store(chunk)
+
+    def close(self):
+        try:
+            for chunk in self.chunker.flush():
+                self._store(chunk)
+            while self._pending:
+                self.uploaded_bytes += self._pending.popleft().result()
+        finally:
+            self._pool.shutdown()
+
+    def abort(self):
+        """Stops uploading. Chunks already stored stay; they are valid and may be reused."""
+        for future in self._pending:
+            future.cancel()
+        self._pool.shutdown()
+
+    def _store(self, chunk):
+        sha = hashlib.sha256(chunk).hexdigest()
+        self.chunks.append([sha, len(chunk)])
+        key = chunk_key(sha, self.codec)
+        if key in self.known:
+            return
+        self.known.add(key)
+        self.new_chunks += 1
+        if len(self._pending) >= 2 * self._uploads:
+            self.uploaded_bytes += self._pending.popleft().result()
+        self._pending.append(self._pool.submit(self._upload, key, chunk))
+
+    def _upload(self, key, chunk):
+        body = self.codec.compress(chunk, self.level)
+        self.s3.put_object(Bucket=self.bucket, Key=key, Body=body, Metadata={"codec": self.codec.name})
+        return len(body)
+
+
+def known_chunks(s3, bucket):
+    """Keys of every chunk already in the store."""
+    keys = set()
+    for page in s3.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=CHUNK_PREFIX):
+        keys.update(obj["Key"] for obj in page.get("Contents", []))
+    return keys
+
+
+def write_recipe(s3, bucket, filename, writer):
+    s3.put_object(
+        Bucket=bucket,
+        Key=filename,
+        Body=json.dumps({"codec": writer.codec.name, "chunks": writer.chunks}).encode(),
+        ContentType="application/json",
+        Metadata={"backup-format": FORMAT_DEDUP, "codec": writer.codec.name},
+    )
+
+
+def load_recipe(s3, bucket, filename):
+    return json.loads(s3.get_object(Bucket=bucket, Key=filename)["Body"].read())
+
+
+def read_chunks(s3, bucket, recipe, codec, lookahead=8):
+    """
+    Yields the original stream of a dedup backup, chunk by chunk, fetching up to
+    `lookahead` chunks ahead in parallel. Every chunk is checked against its SHA-256.
+    """
+    def fetch(entry):
+        sha, raw_length = entry
+        body = s3.get_object(Bucket=bucket, Key=chunk_key(sha, codec))["Body"].read()
+        decompressor = codec.decompressor()
+        data = decompressor.decompress(body) + decompressor.flush()
+        if len(data) != raw_length or hashlib.sha256(data).hexdigest() != sha:
+            raise ValueError(f"Chunk {sha} is corrupt")
+        return data
+
+    with ThreadPoolExecutor(max_workers=lookahead) as pool:
+        pending = deque()
+        entries = iter(recipe["chunks"])
+        for entry in entries:
+            pending.append(pool.submit(fetch, entry))
+            if len(pending) >= lookahead:
+                break
+        while pending:
+            data = pending.popleft().result()
+            entry = next(entries, None)
+            if entry is not None:
+                pending.append(pool.submit(fetch, entry))
+            yield data
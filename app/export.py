@@ -0,0 +1,485 @@
+import hashlib
+import math
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2
+from psycopg2 import sql
+
+from .manifest import new_manifest, write_manifest, load_manifest, combined_sha256, FORMAT_COPY
+from .streaming import MultipartUploader, pipe_into_process, prefetch_object, stream_dump, MB
+
+TABLES_QUERY = """
+    SELECT n.nspname, c.relname, c.reltuples::bigint
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE c.relkind = 'r'
+      AND c.relpersistence <> 't'
+      AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+      AND n.nspname NOT LIKE 'pg_toast%%'
+    ORDER BY c.reltuples DESC
+"""
+
+COLUMNS_QUERY = """
+    SELECT a.attname
+    FROM pg_attribute a
+    WHERE a.attrelid = %s::regclass AND a.attnum > 0 AND NOT a.attisdropped AND a.attgenerated = ''
+    ORDER BY a.attnum
+"""
+
+# Single-column integer primary key, used to split a table into ranges.
+INTEGER_PK_QUERY = """
+    SELECT a.attname
+    FROM pg_index i
+    JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+    WHERE i.indrelid = %s::regclass AND i.indisprimary AND i.indnkeyatts = 1
+      AND a.atttypid IN ('int2'::regtype, 'int4'::regtype, 'int8'::regtype)
+"""
+
+PRIMARY_KEY_QUERY = """
+    SELECT a.attname
+    FROM pg_index i
+    JOIN LATERAL unnest(i.indkey) WITH ORDINALITY AS k(attnum, ord) ON true
+    JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = k.attnum
+    WHERE i.indrelid = %s::regclass AND i.indisprimary
+    ORDER BY k.ord
+"""
+
+# Changes whenever a table is rewritten (TRUNCATE, VACUUM FULL, CLUSTER) or rows are written.
+# stats_reset tells counters that restarted from zero (after a crash or reset) from old ones.
+FINGERPRINT_QUERY = """
+    SELECT n.nspname || '.' || c.relname, c.relfilenode, s.n_tup_ins, s.n_tup_upd, s.n_tup_del,
+           (SELECT stats_reset::text FROM pg_stat_database WHERE datname = current_database())
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid
+    WHERE c.relkind = 'r'
+"""
+
+# Backends report their counters some time after commit (up to about 10 s when idle), so
+# reused tables are checked again at least this long after the snapshot was taken.
+STATS_SETTLE_SECONDS = 10
+
+SEQUENCES_QUERY = """
+    SELECT schemaname, sequencename, last_value FROM pg_sequences WHERE last_value IS NOT NULL
+"""
+
+
+def _qualified(schema, table):
+    return sql.SQL("{}.{}").format(sql.Identifier(schema), sql.Identifier(table))
+
+
+def _chunk_ranges(lo, hi, estimated_rows, chunk_rows):
+    """Splits [lo, hi] into roughly equal half-open key ranges of about `chunk_rows` rows each."""
+    count = max(1, math.ceil(max(estimated_rows, 0) / chunk_rows))
+    step = max(1, math.ceil((hi - lo + 1) / count))
+    ranges = []
+    start = lo
+    while start <= hi:
+        ranges.append([start, min(start + step, hi + 1)])
+        start += step
+    return ranges
+
+
+def plan_export(cur, chunk_rows, table_filter=None):
+    """
+    Lists every table with its column list and the key ranges it will be exported in.
+    Must run inside the snapshot transaction so the ranges match what workers see.
+
+    `table_filter(cur, table)` may return a sql.Composable WHERE condition to export only
+    part of a table (exported as one chunk); it may also annotate the table dict.
+    """
+    cur.execute(TABLES_QUERY)
+    tables = []
+    for schema, table, estimated_rows in cur.fetchall():
+        name = f"{schema}.{table}"
+        regclass = _qualified(schema, table).as_string(cur.connection)
+        cur.execute(COLUMNS_QUERY, (regclass,))
+        columns = [row[0] for row in cur.fetchall()]
+        cur.execute(PRIMARY_KEY_QUERY, (regclass,))
+        primary_key = [row[0] for row in cur.fetchall()]
+        entry = {
+            "name": name, "schema": schema, "table": table, "columns": columns, "primary_key": primary_key,
+            "estimated_rows": estimated_rows, "key": None, "ranges": [None],
+        }
+        tables.append(entry)
+
+        condition = table_filter(cur, entry) if table_filter else None
+        if condition is not None:
+            entry["filter"] = condition.as_string(cur.connection)
+            continue
+
+        cur.execute(INTEGER_PK_QUERY, (regclass,))
+        row = cur.fetchone()
+        key, ranges = None, [None]
+        if row and estimated_rows > chunk_rows:
+            key = row[0]
+            cur.execute(sql.SQL("SELECT min({k}), max({k}) FROM {t}").format(k=sql.Identifier(key), t=_qualified(schema, table)))
+            lo, hi = cur.fetchone()
+            if lo is not None:
+                ranges = _chunk_ranges(lo, hi, estimated_rows, chunk_rows)
+        entry["key"], entry["ranges"] = key, ranges
+    return tables
+
+
+def table_counters(database_url):
+    """
+    relfilenode and write counters of every table, for table_fingerprint. Read on a separate
+    connection before the export snapshot is taken: counters are not part of any snapshot,
+    so a write they include has committed before the snapshot and is in the exported data.
+    A write committed before the snapshot but not yet reported is missed; for tables
+    fingerprinted by counters alone, export_snapshot_backup catches it with moved_tables.
+    """
+    conn = psycopg2.connect(database_url)
+    try:
+        cur = conn.cursor()
+        cur.execute(FINGERPRINT_QUERY)
+        return {row[0]: list(row[1:]) for row in cur.fetchall()}
+    finally:
+        conn.close()
+
+
+def moved_tables(cur, tables, counters):
+    """
+    Names among `tables` whose relfilenode or write counters now differ from `counters`.
+    Clears the transaction's statistics snapshot first, so it can run in the coordinator.
+    """
+    cur.execute("SELECT pg_stat_clear_snapshot()")
+    cur.execute(FINGERPRINT_QUERY)
+    current = {row[0]: list(row[1:]) for row in cur.fetchall()}
+    return [table["name"] for table in tables if current.get(table["name"]) != counters.get(table["name"])]
+
+
+def table_fingerprint(cur, table, counters, hash_max_rows=100000):
+    """
+    A digest that changes when the table's contents change: its relfilenode and cumulative
+    insert/update/delete counters from `counters` (see table_counters), plus, for tables of
+    at most `hash_max_rows` estimated rows, an order-independent hash aggregate of every row.
+    Counters are reported by backends with a short delay, so a write committed moments
+    before the backup may only be noticed by the next one; the row hash closes that gap
+    for small tables.
+    """
+    parts = list(counters.get(table["name"], [None]))
+    if table["estimated_rows"] <= hash_max_rows:
+        cur.execute(sql.SQL("SELECT count(*), coalesce(sum(hashtext(t::text)::bigint), 0) FROM {} t").format(
+            _qualified(table["schema"], table["table"])
+        ))
+        parts.extend(cur.fetchone())
+    return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+
+def copy_out_query(conn, table, key_range, copy_format="text"):
+    """Builds the COPY ... TO STDOUT statement for one chunk of `table`."""
+    columns = sql.SQL(", ").join(sql.Identifier(c) for c in table["columns"])
+    source = _qualified(table["schema"], table["table"])
+    conditions = []
+    if key_range is not None:
+        conditions.append(sql.SQL("{k} >= {lo} AND {k} < {hi}").format(
+            k=sql.Identifier(table["key"]), lo=sql.Literal(key_range[0]), hi=sql.Literal(key_range[1])
+        ))
+    if table.get("filter"):
+        conditions.append(sql.SQL("({})").format(sql.SQL(table["filter"])))
+    select = sql.SQL("SELECT {c} FROM {t}").format(c=columns, t=source)
+    if conditions:
+        select = sql.SQL("{} WHERE {}").format(select, sql.SQL(" AND ").join(conditions))
+    options = sql.SQL(" (FORMAT binary)") if copy_format == "binary" else sql.SQL("")
+    return sql.SQL("COPY ({}) TO STDOUT{}").format(select, options).as_string(conn)
+
+
+def copy_in_query(conn, table, copy_format="text"):
+    columns = sql.SQL(", ").join(sql.Identifier(c) for c in table["columns"])
+    options = sql.SQL(" (FORMAT binary)") if copy_format == "binary" else sql.SQL("")
+    return sql.SQL("COPY {t} ({c}) FROM STDIN{o}").format(
+        t=_qualified(table["schema"], table["table"]), c=columns, o=options
+    ).as_string(conn)
+
+
+class _CompressingWriter:
+    """File-like target for copy_expert that compresses into a MultipartUploader."""
+
+    def __init__(self, uploader, compressor):
+        self.uploader = uploader
+        self.compressor = compressor
+        self.raw_bytes = 0
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self.raw_bytes += len(data)
+        self.uploader.write(self.compressor.compress(data))
+
+    def close(self):
+        self.uploader.write(self.compressor.flush())
+        self.uploader.close()
+
+
+class DecompressingReader:
+    """File-like source for copy_expert that decompresses an iterable of compressed chunks."""
+
+    def __init__(self, chunks, decompressor):
+        self._chunks = iter(chunks)
+        self._decompressor = decompressor
+        self._buffer = bytearray()
+        self._eof = False
+
+    def read(self, size=-1):
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                self._buffer += self._decompressor.flush()
+                self._eof = True
+            else:
+                self._buffer += self._decompressor.decompress(chunk)
+        if size < 0:
+            size = len(self._buffer)
+        out = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return out
+
+
+def _open_snapshot_connection(database_url, snapshot):
+    conn = psycopg2.connect(database_url)
+    conn.set_session(isolation_level="REPEATABLE READ", readonly=True)
+    cur = conn.cursor()
+    cur.execute("SET TRANSACTION SNAPSHOT %s", (snapshot,))
+    cur.close()
+    return conn
+
+
+def _run_workers(database_url, snapshot, tasks, workers, handle):
+    """
+    Runs `handle(conn, task)` for every task on `workers` threads. Each thread keeps one
+    connection that has imported `snapshot`, so every chunk reads the same data.
+    """
+    pending = queue.Queue()
+    for task in tasks:
+        pending.put(task)
+    results = []
+    errors = []
+
+    def work():
+        conn = None
+        try:
+            conn = _open_snapshot_connection(database_url, snapshot)
+            while not errors:
+                try:
+                    task = pending.get_nowait()
+                except queue.Empty:
+                    return
+                results.append(handle(conn, task))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            if conn is not None:
+                conn.close()
+
+    threads = [threading.Thread(target=work, daemon=True) for _ in range(min(workers, max(len(tasks), 1)))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+    return results
+
+
+def _dump_section(database_url, snapshot, section, s3, bucket, key, codec, level):
+    uploader = MultipartUploader(s3, bucket, key)
+    try:
+        stream_dump(
+            ["pg_dump", f"--section={section}", f"--snapshot={snapshot}", "--no-owner", "--no-privileges", database_url],
+            uploader,
+            codec.compressor(level),
+        )
+        uploader.close()
+    except Exception:
+        uploader.abort()
+        raise
+    return {"key": key, "bytes": uploader.bytes_written, "sha256": uploader.sha256.hexdigest()}
+
+
+def export_snapshot_backup(
+    database_url, s3, bucket, prefix, codec, level=None, workers=4, chunk_rows=500000, copy_format="text",
+    table_filter=None, include_schema=True, manifest_fields=None, previous=None, hash_max_rows=100000,
+):
+    """
+    Exports the whole database from one exported snapshot.
+
+    A coordinating REPEATABLE READ transaction exports its snapshot; `workers` threads
+    import it and COPY disjoint primary-key ranges of each table in parallel, so large
+    tables are split across connections while the backup stays consistent. Each range
+    is stored as its own compressed object under `<prefix>/data/`, alongside pre-data
+    and post-data schema dumps taken from the same snapshot and a manifest written last.
+    `table_filter` is passed to plan_export; `include_schema=False` skips the schema
+    dumps; `manifest_fields` are merged into the manifest.
+
+    Every unfiltered table gets a table_fingerprint. Tables whose fingerprint and columns
+    match those in the `previous` manifest are not exported again: their entry points at
+    the previous backup's chunk objects, and `reused_from` names the backup that owns them.
+    Reused tables fingerprinted without a row hash are re-exported if their counters have
+    moved once they settle (see moved_tables), which can add STATS_SETTLE_SECONDS.
+    Returns the manifest dict.
+    """
+    counters = table_counters(database_url)
+    coordinator = psycopg2.connect(database_url)
+    coordinator.set_session(isolation_level="REPEATABLE READ", readonly=True)
+    try:
+        cur = coordinator.cursor()
+        cur.execute("SELECT pg_export_snapshot(), now()")
+        snapshot, snapshot_time = cur.fetchone()
+        snapshot_clock = time.perf_counter()
+        tables = plan_export(cur, chunk_rows, table_filter)
+        reusable = previous and previous["codec"] == codec.name and previous.get("copy_format", "text") == copy_format
+        reused = {}
+        for table in tables:
+            if table.get("filter"):
+                continue
+            table["fingerprint"] = table_fingerprint(cur, table, counters, hash_max_rows)
+            old = previous["tables"].get(table["name"]) if reusable else None
+            if old and old.get("fingerprint") == table["fingerprint"] and old["columns"] == table["columns"]:
+                reused[table["name"]] = dict(old, reused_from=old.get("reused_from") or previous["backup"])
+        cur.execute(SEQUENCES_QUERY)
+        sequences = [{"name": f"{s}.{n}", "schema": s, "sequence": n, "last_value": v} for s, n, v in cur.fetchall()]
+
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            schema_futures = [
+                pool.submit(_dump_section, database_url, snapshot, section, s3, bucket, f"{prefix}/{section}.sql{codec.extension}", codec, level)
+                for section in (("pre-data", "post-data") if include_schema else ())
+            ]
+
+            tasks = [
+                (table, i, key_range)
+                for table in tables if table["name"] not in reused
+                for i, key_range in enumerate(table["ranges"])
+            ]
+
+            def export_chunk(conn, task):
+                table, index, key_range = task
+                key = f"{prefix}/data/{table['name']}/{index:05d}.{copy_format}{codec.extension}"
+                writer = _CompressingWriter(MultipartUploader(s3, bucket, key), codec.compressor(level))
+                cur = conn.cursor()
+                try:
+                    cur.copy_expert(copy_out_query(conn, table, key_range, copy_format), writer)
+                    writer.close()
+                    rows = cur.rowcount
+                except Exception:
+                    writer.uploader.abort()
+                    raise
+                finally:
+                    cur.close()
+                return table["name"], {
+                    "key": key,
+                    "range": key_range,
+                    "rows": rows,
+                    "raw_bytes": writer.raw_bytes,
+                    "bytes": writer.uploader.bytes_written,
+                    "sha256": writer.uploader.sha256.hexdigest(),
+                }
+
+            started = time.perf_counter()
+            chunks = _run_workers(database_url, snapshot, tasks, workers, export_chunk)
+
+            # Counters may have missed a write committed just before the snapshot. Once they
+            # have settled, re-export (from the same snapshot) every reused table they were
+            # the only evidence for whose counters have moved since.
+            unhashed = [t for t in tables if t["name"] in reused and t["estimated_rows"] > hash_max_rows]
+            if unhashed:
+                time.sleep(max(0.0, STATS_SETTLE_SECONDS - (time.perf_counter() - snapshot_clock)))
+                stale = moved_tables(cur, unhashed, counters)
+                for name in stale:
+                    del reused[name]
+                if stale:
+                    chunks += _run_workers(database_url, snapshot, [
+                        (table, i, key_range)
+                        for table in unhashed if table["name"] in stale
+                        for i, key_range in enumerate(table["ranges"])
+                    ], workers, export_chunk)
+            schema_objects = [future.result() for future in schema_futures]
+    finally:
+        coordinator.close()
+
+    by_table = {
+        t["name"]: {
+            "columns": t["columns"], "primary_key": t["primary_key"], "key": t["key"], "filter": t.get("filter"),
+            "fingerprint": t.get("fingerprint"), "chunks": [],
+        }
+        for t in tables if t["name"] not in reused
+    }
+    for name, chunk in chunks:
+        by_table[name]["chunks"].append(chunk)
+    for entry in by_table.values():
+        entry["chunks"].sort(key=lambda c: c["key"])
+        entry["rows"] = sum(c["rows"] for c in entry["chunks"])
+        entry["bytes"] = sum(c["bytes"] for c in entry["chunks"])
+        entry["raw_bytes"] = sum(c["raw_bytes"] for c in entry["chunks"])
+    by_table.update(reused)
+
+    objects = schema_objects + [c for entry in by_table.values() for c in entry["chunks"]]
+    manifest = new_manifest(
+        prefix,
+        FORMAT_COPY,
+        codec.name,
+        copy_format=copy_format,
+        snapshot_time=snapshot_time.isoformat(),
+        export_seconds=round(time.perf_counter() - started, 1),
+        size=sum(o["bytes"] for o in objects),
+        uploaded_bytes=sum(o["bytes"] for o in schema_objects) + sum(c["bytes"] for _, c in chunks),
+        reused_tables=sorted(reused),
+        sha256=combined_sha256((o["key"], o["sha256"]) for o in objects),
+        pre_data=schema_objects[0]["key"] if include_schema else None,
+        post_data=schema_objects[1]["key"] if include_schema else None,
+        sequences=sequences,
+        tables=by_table,
+        **(manifest_fields or {}),
+    )
+    write_manifest(s3, bucket, prefix, manifest)
+    return manifest
+
+
+def restore_snapshot_backup(s3, bucket, prefix, target_url, codec, jobs=4):
+    """
+    Loads a backup written by export_snapshot_backup into `target_url`: pre-data schema,
+    then every data chunk over `jobs` parallel COPY FROM connections, then indexes and
+    constraints (post-data), and finally sequence positions.
+    """
+    manifest = load_manifest(s3, bucket, prefix)
+    copy_format = manifest.get("copy_format", "text")
+    psql = ["psql", target_url, "--quiet"]
+
+    pipe_into_process(prefetch_object(s3, bucket, manifest["pre_data"]), psql, codec.decompressor())
+
+    tasks = [
+        (name, table, chunk)
+        for name, table in manifest["tables"].items()
+        for chunk in table["chunks"]
+    ]
+
+    def load_chunk(task):
+        name, table, chunk = task
+        schema, _, table_name = name.partition(".")
+        conn = psycopg2.connect(target_url)
+        try:
+            cur = conn.cursor()
+            reader = DecompressingReader(prefetch_object(s3, bucket, chunk["key"]), codec.decompressor())
+            query = copy_in_query(conn, {"schema": schema, "table": table_name, "columns": table["columns"]}, copy_format)
+            cur.copy_expert(query, reader, size=MB)
+            conn.commit()
+        finally:
+            conn.close()
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        list(pool.map(load_chunk, tasks))
+
+    pipe_into_process(prefetch_object(s3, bucket, manifest["post_data"]), psql, codec.decompressor())
+
+    conn = psycopg2.connect(target_url)
+    try:
+        cur = conn.cursor()
+        for seq in manifest["sequences"]:
+            cur.execute("SELECT setval(%s, %s)", (_qualified(seq["schema"], seq["sequence"]).as_string(conn), seq["last_value"]))
+        conn.commit()
+    finally:
+        conn.close()
+    return manifest
@@ -0,0 +1,112 @@
+import datetime
+
+import psycopg2
+from psycopg2 import sql
+
+from .export import TABLES_QUERY, COLUMNS_QUERY, DecompressingReader, _qualified, copy_in_query
+from .manifest import load_manifest
+from .streaming import MB, prefetch_object
+
+# Columns that move forward whenever a row is written, most specific first. created_at is not
+# one: it misses updates, so tables that only have it are exported in full.
+CHANGE_COLUMNS = ("updated_at", "modified_date", "synced_at", "last_synced_at")
+
+
+def table_columns(cur):
+    """`schema.table` -> exported column list, for every user table."""
+    cur.execute(TABLES_QUERY)
+    tables = {}
+    for schema, table, _ in cur.fetchall():
+        cur.execute(COLUMNS_QUERY, (_qualified(schema, table).as_string(cur.connection),))
+        tables[f"{schema}.{table}"] = [row[0] for row in cur.fetchall()]
+    return tables
+
+
+def schema_matches(cur, manifest):
+    """
+    True when the database has the same tables and columns as the backup `manifest`.
+    Deltas carry no DDL, so a schema change needs a new full backup.
+    """
+    current = table_columns(cur)
+    return current == {name: table["columns"] for name, table in manifest["tables"].items()}
+
+
+def change_filter(since, overlap_minutes=5):
+    """
+    Returns a plan_export table filter selecting rows whose change columns are later than
+    `since` (an ISO timestamp) minus `overlap_minutes`, plus rows where every change column
+    is NULL, which carry no change time and so go into every delta. The overlap catches rows
+    written by transactions that were still open when the previous backup's snapshot was taken.
+    Tables without a change column or a primary key are left unfiltered (exported in full).
+    Updates that leave a non-NULL change column unchanged, and deletes, are only picked up
+    by the next full backup.
+    """
+    cutoff = datetime.datetime.fromisoformat(since) - datetime.timedelta(minutes=overlap_minutes)
+
+    def table_filter(cur, table):
+        columns = [c for c in CHANGE_COLUMNS if c in table["columns"]]
+        if not columns or not table["primary_key"]:
+            return None
+        changed = [sql.SQL("{} >= {}").format(sql.Identifier(c), sql.Literal(cutoff)) for c in columns]
+        unset = sql.SQL(" AND ").join(sql.SQL("{} IS NULL").format(sql.Identifier(c)) for c in columns)
+        return sql.SQL(" OR ").join(changed + [sql.SQL("({})").format(unset)])
+
+    return table_filter
+
+
+def backup_chain(s3, bucket, filename):
+    """
+    Follows `parent` links from a backup's manifest back to its full base backup.
+    Returns the manifests oldest first; a full backup is a chain of one.
+    """
+    chain = []
+    while filename:
+        manifest = load_manifest(s3, bucket, filename)
+        if manifest is None:
+            raise ValueError(f"Backup chain is broken: manifest of {filename} is missing")
+        chain.append(manifest)
+        filename = manifest.get("parent")
+    return chain[::-1]
+
+
+def _load_table(cur, s3, bucket, name, table, codec, copy_format, staging):
+    """COPYs every chunk of `table` into the temp table `staging`."""
+    schema, _, table_name = name.partition(".")
+    target = _qualified(schema, table_name)
+    cur.execute(sql.SQL("CREATE TEMP TABLE {} (LIKE {}) ON COMMIT DROP").format(sql.Identifier(staging), target))
+    for chunk in table["chunks"]:
+        reader = DecompressingReader(prefetch_object(s3, bucket, chunk["key"]), codec.decompressor())
+        query = copy_in_query(cur.connection, {"schema": "pg_temp", "table": staging, "columns": table["columns"]}, copy_format)
+        cur.copy_expert(query, reader, size=MB)
+    return target, sql.Identifier(staging)
+
+
+def apply_delta(s3, bucket, manifest, target_url, codec):
+    """
+    Applies an incremental backup on top of a database restored from its parent.
+    Changed rows replace the rows with the same primary key (upsert by delete + insert);
+    tables exported in full are emptied and reloaded. Runs as one transaction with
+    foreign-key triggers disabled (session_replication_role = replica), so the target
+    connection needs superuser rights. Rows deleted at the source are not captured.
+    """
+    copy_format = manifest.get("copy_format", "text")
+    conn = psycopg2.connect(target_url)
+    try:
+        cur = conn.cursor()
+        cur.execute("SET LOCAL session_replication_role = replica")
+        for index, (name, table) in enumerate(manifest["tables"].items()):
+            target, staging = _load_table(cur, s3, bucket, name, table, codec, copy_format, f"_incr_{index}")
+            columns = sql.SQL(", ").join(map(sql.Identifier, table["columns"]))
+            if table.get("filter"):
+                match = sql.SQL(" AND ").join(
+                    sql.SQL("t.{c} = s.{c}").format(c=sql.Identifier(c)) for c in table["primary_key"]
+                )
+                cur.execute(sql.SQL("DELETE FROM {} t USING {} s WHERE {}").format(target, staging, match))
+            else:
+                cur.execute(sql.SQL("DELETE FROM {}").format(target))
+            cur.execute(sql.SQL("INSERT INTO {t} ({c}) SELECT {c} FROM {s}").format(t=target, c=columns, s=staging))
+        for seq in manifest["sequences"]:
+            cur.execute("SELECT setval(%s, %s)", (_qualified(seq["schema"], seq["sequence"]).as_string(conn), seq["last_value"]))
+        conn.commit()
+    finally:
+        conn.close()
@@ -0,0 +1,42 @@
+import datetime
+import re
+
+from psycopg2.extensions import parse_dsn
+
+LAYOUT_FLAT = "flat"
+TIMESTAMP_RE = re.compile(r"backup_(\d{8}_\d{6})")
+
+
+def database_name(database_url):
+    try:
+        return parse_dsn(database_url or "").get("dbname") or "postgres"
+    except Exception:
+        return "postgres"
+
+
+def backup_time(name):
+    """The timestamp embedded in a backup name (`backup_YYYYMMDD_HHMMSS...`), or None."""
+    match = TIMESTAMP_RE.search(name)
+    return datetime.datetime.strptime(match.group(1), "%Y%m%d_%H%M%S") if match else None
+
+
+def _prefix(layout, db, day):
+    return layout.format(db=db, yyyy=f"{day:%Y}", mm=f"{day:%m}", dd=f"{day:%d}").strip("/") + "/"
+
+
+def key_for(name, layout, db):
+    """
+    Full object key for backup `name` under `layout`: "flat" keeps everything at the bucket
+    root; a template such as `db/{db}/{yyyy}/{mm}/{dd}` files each backup under its day.
+    """
+    when = backup_time(name)
+    if not layout or layout == LAYOUT_FLAT or when is None:
+        return name
+    return _prefix(layout, db, when) + name
+
+
+def day_prefixes(layout, db, since, until=None):
+    """The prefixes holding backups taken between `since` and `until` (dates), oldest first."""
+    until = until or datetime.date.today()
+    days = (until - since).days
+    return [_prefix(layout, db, since + datetime.timedelta(days=i)) for i in range(days + 1)]
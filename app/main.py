@@ -1,4 +1,4 @@
-from fastapi import FastAPI, Request, BackgroundTasks, Depends, HTTPException
+from fastapi import FastAPI, Request, BackgroundTasks, Depends, HTTPException, Body
 from fastapi.responses import HTMLResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
@@ -6,7 +6,12 @@ from apscheduler.schedulers.background import BackgroundScheduler
 import os
 import datetime
 import json
-from .backup import perform_backup, init_db, get_db_connection, list_backups, perform_restore, get_test_db_info
+from .backup import (
+    perform_backup, perform_scheduled_backup, init_db, get_db_connection, list_backups, perform_restore, get_test_db_info, get_backup_manifest,
+    start_wal_archiving, stop_wal_archiving, perform_base_backup, perform_pitr_restore, get_config, rebuild_backup_catalog, list_recent_backups,
+    perform_retention, archive_cache_stats, prepare_test_template, reset_test_db, get_test_template_info,
+    perform_table_restore, perform_subset_backup, release_wal_slot, get_pitr_unavailable,
+)
 
 app = FastAPI(title="Sentinel Backup Service")
 
@@ -15,7 +20,9 @@ scheduler = BackgroundScheduler()
 
 def scheduled_job():
     print("Running scheduled backup...")
-    perform_backup()
+    perform_scheduled_backup()
+    if get_config()["RETENTION_ENABLED"]:
+        perform_retention()
 
 @app.on_event("startup")
 def startup_event():
@@ -25,9 +32,29 @@ def startup_event():
     minute = int(os.getenv("BACKUP_CRON_MINUTE", 0))
     
     scheduler.add_job(scheduled_job, 'cron', hour=hour, minute=minute)
+
+    # Continuous WAL archiving for point-in-time restore, with periodic base backups.
+    config = get_config()
+    if config["WAL_ARCHIVE_ENABLED"]:
+        try:
+            start_wal_archiving()
+            scheduler.add_job(perform_base_backup, 'interval', hours=config["BASEBACKUP_INTERVAL_HOURS"], next_run_time=datetime.datetime.now())
+        except Exception as e:
+            print(f"Error starting WAL archiving: {e}")
+    else:
+        try:
+            release_wal_slot()
+        except Exception as e:
+            print(f"Error dropping WAL replication slot: {e}")
+
     scheduler.start()
     print(f"Scheduler started. Backup set for {hour:02d}:{minute:02d} daily.")
 
+@app.on_event("shutdown")
+def shutdown_event():
+    scheduler.shutdown(wait=False)
+    stop_wal_archiving()
+
 # --- UI Setup ---
 templates = Jinja2Templates(directory="app/templates")
 
@@ -48,7 +75,7 @@ async def dashboard(request: Request):
     conn = get_db_connection()
     cur = conn.cursor()
     # Fetch last 50 logs
-    cur.execute("SELECT id, timestamp, status, filename, size_bytes, message FROM _admin_backup_logs ORDER BY timestamp DESC LIMIT 50")
+    cur.execute("SELECT id, timestamp, status, filename, size_bytes, message, codec, compression_ratio, compress_mb_per_s FROM _admin_backup_logs ORDER BY timestamp DESC LIMIT 50")
     logs = cur.fetchall()
     cur.close()
     conn.close()
@@ -62,7 +89,8 @@ async def dashboard(request: Request):
             "status": log[2],
             "filename": log[3],
             "size": f"{size_mb} MB",
-            "message": log[5]
+            "message": log[5],
+            "compression": f"{log[6]} {log[7]}x @ {log[8]} MB/s" if log[7] else (log[6] or "")
         })
 
     # Fetch available backups for restoration
@@ -73,10 +101,13 @@ async def dashboard(request: Request):
         "request": request, 
         "logs": formatted_logs,
         "backups": available_backups,
-        "test_db_info": test_db_info
+        "test_db_info": test_db_info,
+        "cache_stats": archive_cache_stats(),
+        "pitr_unavailable": get_pitr_unavailable(),
+        "template_info": get_test_template_info(),
     })
 
-@app.post("/restore/{filename}")
+@app.post("/restore/{filename:path}")
 async def restore_to_test(filename: str, background_tasks: BackgroundTasks):
     # For restoration, we might want to track it in logs too, but for now just run it
     # We can do it synchronously if it's not too large, or background it.
@@ -84,11 +115,83 @@ async def restore_to_test(filename: str, background_tasks: BackgroundTasks):
     background_tasks.add_task(perform_restore, filename)
     return {"message": f"Restoration of {filename} to Test DB started in background"}
 
+@app.post("/restore-tables/{filename:path}")
+def restore_tables_to_test(filename: str, tables: str, closure: str = "none"):
+    names = [t.strip() for t in tables.split(",") if t.strip()]
+    if not names:
+        raise HTTPException(status_code=400, detail="No tables given")
+    success, message = perform_table_restore(filename, names, closure)
+    if not success:
+        raise HTTPException(status_code=500, detail=message)
+    return {"message": message}
+
+@app.post("/test-db/template/{filename:path}")
+async def make_test_template(filename: str, background_tasks: BackgroundTasks):
+    background_tasks.add_task(prepare_test_template, filename)
+    return {"message": f"Restoring {filename} and saving it as the Test DB template in background"}
+
+@app.post("/test-db/reset")
+def reset_test_database():
+    success, message = reset_test_db()
+    if not success:
+        raise HTTPException(status_code=500, detail=message)
+    return {"message": message}
+
+@app.post("/restore-pitr")
+async def restore_point_in_time(target_time: str, background_tasks: BackgroundTasks):
+    unavailable = get_pitr_unavailable()
+    if unavailable:
+        raise HTTPException(status_code=501, detail=f"Point-in-time restore unavailable: {unavailable}")
+    try:
+        datetime.datetime.fromisoformat(target_time)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid target_time: {target_time}")
+    background_tasks.add_task(perform_pitr_restore, target_time)
+    return {"message": f"Point-in-time restore to {target_time} started in background"}
+
+@app.get("/backups")
+def recent_backups(days: int = 7):
+    return list_recent_backups(days)
+
+@app.get("/backups/{filename:path}/manifest")
+def backup_manifest(filename: str):
+    manifest = get_backup_manifest(filename)
+    if manifest is None:
+        raise HTTPException(status_code=404, detail=f"No manifest for {filename}")
+    return manifest
+
 @app.post("/trigger-backup")
 async def trigger_backup(background_tasks: BackgroundTasks):
     background_tasks.add_task(perform_backup)
     return {"message": "Backup triggered in background"}
 
+@app.post("/subset-backup")
+async def trigger_subset_backup(background_tasks: BackgroundTasks, spec: dict = Body(default={})):
+    # Body (all optional, defaults from SUBSET_*): {"full_tables": ["category"], "child_depth": 1}.
+    # Seeds hold raw SQL conditions, so they are only read from SUBSET_SEEDS, never from a request.
+    if "seeds" in spec:
+        raise HTTPException(status_code=400, detail="Seeds are configured with SUBSET_SEEDS, not per request")
+    full_tables = spec.get("full_tables")
+    if full_tables is not None and not (isinstance(full_tables, list) and all(isinstance(t, str) for t in full_tables)):
+        raise HTTPException(status_code=400, detail="full_tables must be a list of table names")
+    child_depth = spec.get("child_depth")
+    if child_depth is not None and not isinstance(child_depth, int):
+        raise HTTPException(status_code=400, detail="child_depth must be an integer")
+    background_tasks.add_task(perform_subset_backup, None, full_tables, child_depth)
+    return {"message": "Subset backup triggered in background"}
+
+@app.post("/catalog/rebuild")
+def rebuild_catalog():
+    success, message = rebuild_backup_catalog()
+    return {"message": message}
+
+@app.post("/retention/run")
+def run_retention(dry_run: bool = True):
+    success, message = perform_retention(dry_run=dry_run)
+    if not success:
+        raise HTTPException(status_code=500, detail=message)
+    return {"message": message}
+
 @app.get("/health")
 def health_check():
     return {"status": "ok"}
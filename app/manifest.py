@@ -0,0 +1,188 @@
+import hashlib
+import json
+import subprocess
+import time
+
+from botocore.exceptions import ClientError
+
+MANIFEST_NAME = "manifest.json"
+MANIFEST_SUFFIX = ".manifest.json"
+MANIFEST_VERSION = 1
+
+# Formats written by the backup modes in app/backup.py.
+FORMAT_PLAIN = "plain"
+FORMAT_CUSTOM = "custom"
+FORMAT_DIRECTORY = "directory"
+FORMAT_COPY = "copy"
+FORMAT_DEDUP = "dedup"
+
+# Backups stored as many objects under a `<name><suffix>/` prefix rather than one object.
+PREFIX_FORMATS = {".dir": FORMAT_DIRECTORY, ".copy": FORMAT_COPY}
+
+TABLE_STATS_QUERY = """
+    SELECT schemaname, relname, n_live_tup, pg_total_relation_size(relid)
+    FROM pg_stat_user_tables
+"""
+
+
+def is_prefix_backup(filename):
+    return filename.endswith(tuple(PREFIX_FORMATS))
+
+
+def manifest_key(filename):
+    """Prefix backups keep their manifest inside the prefix; single objects get a sidecar."""
+    if is_prefix_backup(filename):
+        return f"{filename}/{MANIFEST_NAME}"
+    return f"{filename}{MANIFEST_SUFFIX}"
+
+
+def new_manifest(filename, fmt, codec_name, **fields):
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "backup": filename,
+        "format": fmt,
+        "codec": codec_name,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "pg_dump_version": pg_dump_version(),
+        "tables": {},
+    }
+    manifest.update(fields)
+    return manifest
+
+
+def write_manifest(s3, bucket, filename, manifest):
+    s3.put_object(
+        Bucket=bucket,
+        Key=manifest_key(filename),
+        Body=json.dumps(manifest, indent=2, default=str).encode(),
+        ContentType="application/json",
+    )
+
+
+def load_manifest(s3, bucket, filename):
+    """Returns the manifest of `filename`, or None for backups taken before manifests existed."""
+    try:
+        body = s3.get_object(Bucket=bucket, Key=manifest_key(filename))["Body"].read()
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+            return None
+        raise
+    return json.loads(body)
+
+
+def pg_dump_version():
+    try:
+        return subprocess.run(["pg_dump", "--version"], check=True, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def combined_sha256(objects):
+    """A single digest for a multi-object backup, over each member's key and SHA-256."""
+    digest = hashlib.sha256()
+    for key, sha in sorted(objects):
+        digest.update(f"{key}:{sha}\n".encode())
+    return digest.hexdigest()
+
+
+def table_stats(cur):
+    """Catalog row estimates and on-disk sizes, for formats where exact counts are not seen."""
+    cur.execute(TABLE_STATS_QUERY)
+    return {f"{schema}.{table}": {"rows_estimate": rows, "relation_bytes": size} for schema, table, rows, size in cur.fetchall()}
+
+
+def _copy_table_name(header):
+    """`COPY public."user" (id, ...) FROM stdin;` -> `public.user`"""
+    text = header.decode("utf-8", "replace")[len("COPY "):]
+    end = text.find(" (")
+    if end < 0:
+        end = text.find(" FROM")
+    return text[:end].replace('"', "")
+
+
+class PlainDumpIndexer:
+    """
+    Watches the uncompressed stream of a plain-format pg_dump and records, for every
+    table, the byte range of its `COPY ... FROM stdin;` block and its exact row count.
+    Uses bytes.find/count over whole chunks, so it keeps pace with pg_dump.
+    """
+
+    def __init__(self):
+        self.tables = {}
+        self.raw_bytes = 0
+        self._pending = b""
+        self._current = None
+
+    def feed(self, data):
+        self.raw_bytes += len(data)
+        buf = self._pending + data
+        end = buf.rfind(b"\n") + 1
+        self._pending = buf[end:]
+        # Offset of buf[0] in the whole stream.
+        self._scan(buf[:end], self.raw_bytes - len(buf))
+
+    def _scan(self, lines, base):
+        pos = 0
+        while pos < len(lines):
+            if self._current is None:
+                if lines.startswith(b"COPY ", pos):
+                    start = pos
+                else:
+                    found = lines.find(b"\nCOPY ", pos)
+                    if found < 0:
+                        return
+                    start = found + 1
+                eol = lines.index(b"\n", start)
+                header = lines[start:eol]
+                pos = eol + 1
+                if header.endswith(b"FROM stdin;"):
+                    self._current = {"name": _copy_table_name(header), "raw_offset": base + start, "rows": 0}
+            else:
+                if lines.startswith(b"\\.\n", pos):
+                    terminator = pos
+                else:
+                    found = lines.find(b"\n\\.\n", pos - 1 if pos else 0)
+                    if found < 0:
+                        self._current["rows"] += lines.count(b"\n", pos)
+                        return
+                    terminator = found + 1
+                self._current["rows"] += lines.count(b"\n", pos, terminator)
+                pos = terminator + 3
+                table = self._current
+                name = table.pop("name")
+                self.tables[name] = dict(table, raw_length=base + pos - table["raw_offset"])
+                self._current = None
+
+
+def blocks_for_range(blocks, raw_offset, raw_length):
+    """
+    Given a manifest block map ([raw_offset, raw_length, offset, length] per independently
+    compressed block), returns the blocks covering the raw byte range.
+    """
+    raw_end = raw_offset + raw_length
+    return [b for b in blocks if b[0] < raw_end and b[0] + b[1] > raw_offset]
+
+
+def directory_table_files(dump_dir, files):
+    """Maps `schema.table` to its data file (one of `files`) in a pg_dump directory archive, using its TOC."""
+    listing = subprocess.run(["pg_restore", "--list", dump_dir], check=True, capture_output=True, text=True).stdout
+    mapping = {}
+    for line in listing.splitlines():
+        if line.startswith(";") or " TABLE DATA " not in line:
+            continue
+        dump_id, _, rest = line.partition(";")
+        parts = rest.split(" TABLE DATA ", 1)[1].split()
+        if len(parts) < 2:
+            continue
+        data_file = next((f for f in files if f.startswith(f"{dump_id.strip()}.dat")), None)
+        if data_file:
+            mapping[f"{parts[0]}.{parts[1]}"] = data_file
+    return mapping
@@ -0,0 +1,121 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .manifest import new_manifest, write_manifest, combined_sha256, directory_table_files, file_sha256, FORMAT_DIRECTORY
+
+
+def _open_files_under(directory):
+    """
+    Returns the set of paths under `directory` currently held open by any process,
+    or None when /proc is not available to tell.
+    """
+    if not os.path.isdir("/proc"):
+        return None
+    directory = os.path.realpath(directory) + os.sep
+    open_paths = set()
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        fd_dir = f"/proc/{pid}/fd"
+        try:
+            fds = os.listdir(fd_dir)
+        except OSError:
+            continue
+        for fd in fds:
+            try:
+                target = os.readlink(f"{fd_dir}/{fd}")
+            except OSError:
+                continue
+            if target.startswith(directory):
+                open_paths.add(target)
+    return open_paths
+
+
+def _finished_files(dump_dir, seen):
+    """Data files pg_dump has closed and that have not been picked up yet."""
+    if not os.path.isdir(dump_dir):
+        return []
+    # List first: a file that exists but is not open afterwards has been closed, whereas a
+    # file created after the open-file scan would look closed while pg_dump still writes it.
+    names = sorted(os.listdir(dump_dir))
+    open_paths = _open_files_under(dump_dir)
+    if open_paths is None:
+        return []
+    finished = []
+    for name in names:
+        path = os.path.realpath(os.path.join(dump_dir, name))
+        # toc.dat is only complete once pg_dump exits.
+        if name in seen or name == "toc.dat" or path in open_paths:
+            continue
+        finished.append(name)
+    return finished
+
+
+def dump_directory(database_url, s3, bucket, prefix, jobs=4, poll_interval=1.0, table_stats=None):
+    """
+    Runs `pg_dump -Fd -j <jobs>` and uploads every per-table file to `<prefix>/<file>`
+    as soon as pg_dump closes it, deleting the local copy once uploaded.
+    A manifest listing all files (with SHA-256) and the table each one holds is written
+    last, so a prefix without one is incomplete. `table_stats` (see manifest.table_stats)
+    adds catalog row estimates per table.
+    Returns the manifest dict. Raises subprocess.CalledProcessError if the dump fails.
+    """
+    workdir = tempfile.mkdtemp(prefix="backup_dir_")
+    dump_dir = os.path.join(workdir, "dump")
+    command = ["pg_dump", "-Fd", "-j", str(jobs), "-f", dump_dir, database_url]
+    uploaded = {}
+    futures = []
+
+    def upload(name):
+        path = os.path.join(dump_dir, name)
+        size, sha = os.path.getsize(path), file_sha256(path)
+        s3.upload_file(path, bucket, f"{prefix}/{name}")
+        os.remove(path)
+        uploaded[name] = {"name": name, "size": size, "sha256": sha}
+
+    try:
+        with tempfile.TemporaryFile() as stderr, ThreadPoolExecutor(max_workers=jobs) as pool:
+            process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=stderr)
+            seen = set()
+            while process.poll() is None:
+                for name in _finished_files(dump_dir, seen):
+                    seen.add(name)
+                    futures.append(pool.submit(upload, name))
+                time.sleep(poll_interval)
+
+            if process.returncode != 0:
+                for future in futures:
+                    future.cancel()
+                stderr.seek(0)
+                raise subprocess.CalledProcessError(process.returncode, command, stderr=stderr.read())
+
+            # toc.dat is still local here, so the TOC can name each data file's table.
+            table_files = directory_table_files(dump_dir, seen | set(os.listdir(dump_dir)))
+            for name in sorted(os.listdir(dump_dir)):
+                if name not in seen:
+                    futures.append(pool.submit(upload, name))
+            for future in futures:
+                future.result()
+
+        files = [uploaded[name] for name in sorted(uploaded)]
+        tables = {}
+        for table, name in sorted(table_files.items()):
+            tables[table] = dict((table_stats or {}).get(table, {}), file=name, bytes=uploaded[name]["size"])
+        manifest = new_manifest(
+            prefix,
+            FORMAT_DIRECTORY,
+            "gzip",
+            jobs=jobs,
+            size=sum(f["size"] for f in files),
+            sha256=combined_sha256((f["name"], f["sha256"]) for f in files),
+            files=files,
+            tables=tables,
+        )
+        write_manifest(s3, bucket, prefix, manifest)
+        return manifest
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
@@ -0,0 +1,51 @@
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from .manifest import load_manifest, FORMAT_PLAIN, FORMAT_CUSTOM, PREFIX_FORMATS
+
+
+def detect_backup_format(s3, bucket, filename):
+    """
+    Works out the archive format of a backup from its object metadata,
+    falling back to the key suffix for backups written before metadata was set.
+    """
+    for suffix, fmt in PREFIX_FORMATS.items():
+        if filename.endswith(suffix):
+            return fmt
+    head = s3.head_object(Bucket=bucket, Key=filename)
+    fmt = head.get("Metadata", {}).get("backup-format")
+    if fmt:
+        return fmt
+    if filename.endswith(".dump"):
+        return FORMAT_CUSTOM
+    return FORMAT_PLAIN
+
+
+def download_directory_backup(s3, bucket, prefix, dest_dir, jobs=4):
+    """Downloads every file listed in a directory backup's manifest into `dest_dir`."""
+    manifest = load_manifest(s3, bucket, prefix)
+    os.makedirs(dest_dir, exist_ok=True)
+
+    def download(name):
+        s3.download_file(bucket, f"{prefix}/{name}", os.path.join(dest_dir, name))
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        list(pool.map(download, [f["name"] for f in manifest["files"]]))
+    return manifest
+
+
+def pg_restore(target_url, path, jobs=4):
+    """
+    Loads a custom or directory archive with `pg_restore --jobs`, so tables and
+    indexes are rebuilt over several connections at once.
+    """
+    command = [
+        "pg_restore",
+        "--jobs", str(jobs),
+        "--no-owner",
+        "--no-privileges",
+        "--dbname", target_url,
+        path,
+    ]
+    subprocess.run(command, check=True, capture_output=True)
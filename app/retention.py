@@ -0,0 +1,179 @@
+import datetime
+
+from .catalog import TIME_FORMAT, walk_backups
+from .codecs import get_codec
+from .dedup import CHUNK_PREFIX, RECIPE_SUFFIX, chunk_key, load_recipe
+from .layout import backup_time
+from .manifest import load_manifest, manifest_key, is_prefix_backup, MANIFEST_SUFFIX
+from .subset import SUBSET_SUFFIX
+from .wal import BASE_PREFIX, WAL_PREFIX, HISTORY_RE, _list_keys, _segment_range
+
+# delete_objects accepts at most this many keys per request.
+DELETE_BATCH = 1000
+
+# Grandfather-father-son tiers: the period each kept backup stands for.
+PERIODS = {
+    "hourly": lambda t: t.strftime("%Y-%m-%d %H"),
+    "daily": lambda t: t.strftime("%Y-%m-%d"),
+    "weekly": lambda t: "%d-W%02d" % t.isocalendar()[:2],
+    "monthly": lambda t: t.strftime("%Y-%m"),
+}
+
+
+def taken_at(entry):
+    """When a catalog entry's backup was taken: the timestamp in its name, else its upload time."""
+    return backup_time(entry["filename"].rsplit("/", 1)[-1]) or datetime.datetime.strptime(entry["last_modified"], TIME_FORMAT)
+
+
+def select_retained(backups, keep):
+    """
+    Applies grandfather-father-son retention to catalog entries. `keep` maps each tier in
+    PERIODS to how many periods to keep; within a period the newest backup is kept.
+    Returns {filename: [tiers]} for the backups that stay. The newest backup always stays.
+    """
+    ordered = sorted(backups, key=taken_at, reverse=True)
+    retained = {}
+    for tier, period_of in PERIODS.items():
+        seen = set()
+        for entry in ordered:
+            if len(seen) >= keep.get(tier, 0):
+                break
+            period = period_of(taken_at(entry))
+            if period not in seen:
+                seen.add(period)
+                retained.setdefault(entry["filename"], []).append(tier)
+    if ordered:
+        retained.setdefault(ordered[0]["filename"], []).append("latest")
+    return retained
+
+
+def backup_references(manifest):
+    """Backups whose objects a COPY backup depends on: its incremental parent and base, and reused chunks."""
+    refs = {manifest.get("parent"), manifest.get("base")}
+    refs.update(table.get("reused_from") for table in manifest.get("tables", {}).values())
+    refs.discard(None)
+    refs.discard(manifest.get("backup"))
+    return refs
+
+
+def close_over_references(s3, bucket, names):
+    """Adds every backup that a kept COPY backup (transitively) reads from."""
+    closed, pending = set(), list(names)
+    while pending:
+        name = pending.pop()
+        if name in closed:
+            continue
+        closed.add(name)
+        if name.endswith(".copy"):
+            manifest = load_manifest(s3, bucket, name)
+            if manifest:
+                pending.extend(backup_references(manifest))
+    return closed
+
+
+def backup_objects(s3, bucket, name):
+    """Every object belonging to backup `name`: its members or the object itself, plus its manifest."""
+    if is_prefix_backup(name):
+        keys = []
+        for page in s3.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=f"{name}/"):
+            keys.extend(obj["Key"] for obj in page.get("Contents", []))
+        return keys
+    keys = [name]
+    try:
+        s3.head_object(Bucket=bucket, Key=manifest_key(name))
+        keys.append(manifest_key(name))
+    except Exception:
+        pass
+    return keys
+
+
+def delete_keys(s3, bucket, keys):
+    """Deletes keys in batches of DELETE_BATCH. Returns the keys R2 reported as not deleted."""
+    failed = []
+    keys = list(keys)
+    for i in range(0, len(keys), DELETE_BATCH):
+        response = s3.delete_objects(
+            Bucket=bucket,
+            Delete={"Objects": [{"Key": k} for k in keys[i:i + DELETE_BATCH]], "Quiet": True},
+        )
+        failed.extend(err["Key"] for err in response.get("Errors", []))
+    return failed
+
+
+def referenced_chunks(s3, bucket, recipes):
+    keys = set()
+    for name in recipes:
+        recipe = load_recipe(s3, bucket, name)
+        codec = get_codec(recipe["codec"])
+        keys.update(chunk_key(sha, codec) for sha, _ in recipe["chunks"])
+    return keys
+
+
+def unreferenced_chunks(s3, bucket, started):
+    """
+    Chunk-store objects that no dedup recipe in the bucket uses. Recipes are found with
+    walk_backups rather than from the catalog, which can miss a backup; chunks uploaded since
+    `started` (an aware datetime) are left alone, as a backup may not have written its recipe yet.
+    Call with the chunk store locked.
+    """
+    recipes = [name for name in walk_backups(s3, bucket) if name.endswith(RECIPE_SUFFIX)]
+    live = referenced_chunks(s3, bucket, recipes)
+    orphans = []
+    for page in s3.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=CHUNK_PREFIX):
+        orphans.extend(
+            obj["Key"] for obj in page.get("Contents", [])
+            if obj["Key"] not in live and obj["LastModified"] < started
+        )
+    return orphans
+
+
+def plan_retention(s3, bucket, backups, keep, protected=()):
+    """
+    Works out what retention removes, from the catalog alone plus the manifests of the
+    COPY backups that stay. Subset backups are kept apart from the GFS tiers: the newest
+    `keep["subsets"]` of them stay. Returns (retained {filename: [reasons]}, expired [entries]).
+    `protected` names backups that must stay regardless, e.g. the current incremental chain.
+    """
+    # A subset must never stand in for a full backup in a GFS period.
+    subsets = sorted((entry for entry in backups if entry["filename"].endswith(SUBSET_SUFFIX)), key=taken_at, reverse=True)
+    retained = select_retained([entry for entry in backups if not entry["filename"].endswith(SUBSET_SUFFIX)], keep)
+    for entry in subsets[:keep.get("subsets", 0)]:
+        retained.setdefault(entry["filename"], []).append("subset")
+    for name in protected:
+        retained.setdefault(name, []).append("in use")
+    for name in close_over_references(s3, bucket, list(retained)) - set(retained):
+        retained[name] = ["referenced"]
+    expired = [entry for entry in sorted(backups, key=taken_at) if entry["filename"] not in retained]
+    return retained, expired
+
+
+def plan_archive_retention(s3, bucket, keep_base):
+    """
+    What to prune from the point-in-time archive: base backups beyond the newest `keep_base`
+    (their objects and manifests), and WAL objects holding only segments before the oldest
+    kept base backup's start_segment. Timeline history files always stay. Nothing is pruned
+    when `keep_base` is 0 or no base backup has finished. Returns (base backup keys, WAL keys).
+    """
+    if keep_base <= 0:
+        return [], []
+    manifests = [
+        load_manifest(s3, bucket, key[:-len(MANIFEST_SUFFIX)])
+        for key in _list_keys(s3, bucket, BASE_PREFIX) if key.endswith(MANIFEST_SUFFIX)
+    ]
+    manifests = sorted((m for m in manifests if m), key=lambda m: m["finished_at"], reverse=True)
+    kept, expired = manifests[:keep_base], manifests[keep_base:]
+    if not kept:
+        return [], []
+    oldest = min(m["start_segment"][8:] for m in kept)
+
+    wal = []
+    for key in _list_keys(s3, bucket, WAL_PREFIX):
+        name = key[len(WAL_PREFIX):]
+        if HISTORY_RE.match(name):
+            continue
+        last = _segment_range(key)[1] if ".tar" in name else name[:24]
+        # Segment names start with the timeline; compare positions only, as fetch_wal does.
+        if last[8:] < oldest:
+            wal.append(key)
+    base = [key for m in expired for key in (m["backup"], manifest_key(m["backup"]))]
+    return base, wal
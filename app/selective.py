@@ -0,0 +1,196 @@
+import psycopg2
+from psycopg2 import sql
+
+from .codecs import codec_for_key, get_codec
+from .export import DecompressingReader, copy_in_query, _qualified
+from .manifest import blocks_for_range, FORMAT_PLAIN, FORMAT_DIRECTORY, FORMAT_COPY
+from .streaming import MB, prefetch_object
+from .transfer import ranged_chunks
+
+CLOSURES = ("none", "parents", "all")
+
+# Every foreign key as (referencing table, referenced table), schema-qualified.
+FOREIGN_KEYS_QUERY = """
+    SELECT cn.nspname || '.' || c.relname, pn.nspname || '.' || p.relname
+    FROM pg_constraint k
+    JOIN pg_class c ON c.oid = k.conrelid
+    JOIN pg_namespace cn ON cn.oid = c.relnamespace
+    JOIN pg_class p ON p.oid = k.confrelid
+    JOIN pg_namespace pn ON pn.oid = p.relnamespace
+    WHERE k.contype = 'f'
+"""
+
+# Columns in the order pg_dump writes them (generated and dropped columns are not dumped).
+DUMP_COLUMNS_QUERY = """
+    SELECT attname FROM pg_attribute
+    WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped AND attgenerated = ''
+    ORDER BY attnum
+"""
+
+SERIAL_COLUMNS_QUERY = """
+    SELECT attname, pg_get_serial_sequence(%s, attname) FROM pg_attribute
+    WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped
+      AND pg_get_serial_sequence(%s, attname) IS NOT NULL
+"""
+
+
+def qualify(name):
+    return name if "." in name else f"public.{name}"
+
+
+def foreign_keys(cur):
+    cur.execute(FOREIGN_KEYS_QUERY)
+    return cur.fetchall()
+
+
+def fk_closure(tables, edges, closure="parents"):
+    """
+    Extends `tables` along foreign keys: "parents" adds every table they reference
+    (transitively), so loaded rows find their referenced rows; "all" also adds the tables
+    referencing them, so no refreshed parent leaves stale children behind.
+    """
+    selected = set(tables)
+    if closure == "none":
+        return selected
+    pending = list(selected)
+    while pending:
+        table = pending.pop()
+        related = [parent for child, parent in edges if child == table]
+        if closure == "all":
+            related += [child for child, parent in edges if parent == table]
+        for other in related:
+            if other not in selected:
+                selected.add(other)
+                pending.append(other)
+    return selected
+
+
+def raw_range(s3, bucket, key, codec, blocks, raw_offset, raw_length, **transfer):
+    """
+    Yields bytes [raw_offset, raw_offset + raw_length) of a single-object backup's
+    uncompressed stream, downloading as little as the format allows: the exact range when
+    uncompressed, the covering blocks when block-compressed, otherwise the object up to
+    that point (a single compressed stream can only be decoded from its start).
+    """
+    first, last, skip = 0, None, raw_offset
+    if codec.name == "none":
+        first, last, skip = raw_offset, raw_offset + raw_length - 1, 0
+    elif blocks:
+        covering = blocks_for_range(blocks, raw_offset, raw_length)
+        first, last = covering[0][2], covering[-1][2] + covering[-1][3] - 1
+        skip = raw_offset - covering[0][0]
+    decompressor = codec.decompressor()
+    remaining = raw_length
+    chunks = ranged_chunks(s3, bucket, key, first=first, last=last, **transfer)
+    try:
+        for chunk in chunks:
+            data = decompressor.decompress(chunk)
+            if skip:
+                dropped = min(skip, len(data))
+                data, skip = data[dropped:], skip - dropped
+            if data:
+                yield data[:remaining]
+                remaining -= min(len(data), remaining)
+            if remaining <= 0:
+                return
+    finally:
+        chunks.close()
+
+
+def _take_copy_block(chunks, length):
+    """Splits a plain dump's `COPY ... FROM stdin;` block into its statement and its rows (without `\\.`)."""
+    buffer = b""
+    for chunk in chunks:
+        buffer += chunk
+        if b"\n" in buffer:
+            break
+    header, _, rest = buffer.partition(b"\n")
+    statement = header.decode()[:-len("stdin;")] + "STDIN"
+
+    def rows():
+        remaining = length - len(header) - 1 - len(b"\\.\n")
+        pending = rest
+        while pending is not None and remaining > 0:
+            yield pending[:remaining]
+            remaining -= len(pending)
+            pending = next(chunks, None)
+
+    return statement, rows()
+
+
+def table_sources(s3, bucket, filename, manifest, tables, cur, **transfer):
+    """
+    For each table, yields (name, COPY ... FROM STDIN statement, readers), read straight from
+    the backup: plain dumps by their manifest byte range, directory archives by the table's
+    data file, COPY backups by the table's chunk objects (one reader per chunk).
+    Nothing else of the backup is downloaded.
+    """
+    fmt = manifest.get("format")
+    if fmt not in (FORMAT_PLAIN, FORMAT_DIRECTORY, FORMAT_COPY):
+        raise ValueError(f"Selective restore needs a plain, directory or COPY backup with a manifest, not {fmt}")
+    if manifest.get("parent"):
+        raise ValueError("Selective restore from an incremental backup is not supported; choose a full backup")
+    missing = [t for t in tables if t not in manifest.get("tables", {})]
+    if missing:
+        raise ValueError(f"Not in backup {filename}: {', '.join(sorted(missing))}")
+
+    passthrough = get_codec("none")
+    for name in sorted(tables):
+        entry = manifest["tables"][name]
+        schema, _, table = name.partition(".")
+        if fmt == FORMAT_PLAIN:
+            codec = get_codec(manifest["codec"])
+            chunks = raw_range(s3, bucket, filename, codec, manifest.get("blocks"), entry["raw_offset"], entry["raw_length"], **transfer)
+            statement, rows = _take_copy_block(chunks, entry["raw_length"])
+            yield name, statement, [DecompressingReader(rows, passthrough.decompressor())]
+        elif fmt == FORMAT_DIRECTORY:
+            # The TOC holds the column list; the test DB was restored from the same schema,
+            # so its columns in dump order match the data file.
+            key = f"{filename}/{entry['file']}"
+            cur.execute(DUMP_COLUMNS_QUERY, (_qualified(schema, table).as_string(cur.connection),))
+            columns = [row[0] for row in cur.fetchall()]
+            statement = copy_in_query(cur.connection, {"schema": schema, "table": table, "columns": columns})
+            yield name, statement, [DecompressingReader(prefetch_object(s3, bucket, key), codec_for_key(key).decompressor())]
+        else:
+            codec = get_codec(manifest["codec"])
+            statement = copy_in_query(cur.connection, {"schema": schema, "table": table, "columns": entry["columns"]}, manifest.get("copy_format", "text"))
+            yield name, statement, [
+                DecompressingReader(prefetch_object(s3, bucket, chunk["key"]), codec.decompressor())
+                for chunk in entry["chunks"]
+            ]
+
+
+def reset_sequences(cur, name):
+    """Moves the sequences owned by `name`'s columns past the highest loaded value."""
+    qualified = _qualified(*name.split(".", 1)).as_string(cur.connection)
+    cur.execute(SERIAL_COLUMNS_QUERY, (qualified, qualified, qualified))
+    for column, sequence in cur.fetchall():
+        cur.execute(
+            sql.SQL("SELECT setval(%s, coalesce(max({c}), 1), max({c}) IS NOT NULL) FROM {t}").format(
+                c=sql.Identifier(column), t=sql.SQL(qualified)
+            ),
+            (sequence,),
+        )
+
+
+def restore_tables(s3, bucket, filename, manifest, tables, target_url, closure="none", **transfer):
+    """
+    Replaces the rows of `tables` (plus their FK closure, see fk_closure) in `target_url` with
+    the backup's. Runs as one transaction with foreign-key triggers disabled
+    (session_replication_role = replica), so the target connection needs superuser rights;
+    other tables are not touched. Returns the list of tables restored.
+    """
+    conn = psycopg2.connect(target_url)
+    try:
+        cur = conn.cursor()
+        selected = fk_closure({qualify(t) for t in tables}, foreign_keys(cur), closure)
+        cur.execute("SET LOCAL session_replication_role = replica")
+        for name, statement, readers in table_sources(s3, bucket, filename, manifest, selected, cur, **transfer):
+            cur.execute(sql.SQL("DELETE FROM {}").format(_qualified(*name.split(".", 1))))
+            for reader in readers:
+                cur.copy_expert(statement, reader, size=MB)
+            reset_sequences(cur, name)
+        conn.commit()
+    finally:
+        conn.close()
+    return sorted(selected)
@@ -0,0 +1,57 @@
+import os
+import threading
+
+import boto3
+from botocore.config import Config
+
+_clients = {}
+_lock = threading.Lock()
+
+
+def _settings():
+    return (
+        os.getenv("R2_ENDPOINT_URL"),
+        os.getenv("R2_ACCESS_KEY_ID"),
+        os.getenv("R2_SECRET_ACCESS_KEY"),
+        int(os.getenv("S3_MAX_POOL_CONNECTIONS", 32)),
+        int(os.getenv("S3_MAX_ATTEMPTS", 5)),
+        os.getenv("S3_RETRY_MODE", "standard"),
+        int(os.getenv("S3_CONNECT_TIMEOUT", 10)),
+        int(os.getenv("S3_READ_TIMEOUT", 60)),
+    )
+
+
+def get_s3_client():
+    """
+    Returns the process-wide R2 client, creating it on first use.
+
+    boto3 clients are thread-safe, so one client (and its connection pool) serves the
+    dashboard, scheduled jobs and every transfer thread: connections and TLS sessions are
+    reused instead of set up per call. The pool holds S3_MAX_POOL_CONNECTIONS keep-alive
+    connections, which should cover the largest UPLOAD/DOWNLOAD_CONCURRENCY in use.
+    Throttling and transient errors are retried S3_MAX_ATTEMPTS times with backoff
+    (S3_RETRY_MODE: standard, or adaptive to also rate-limit client-side).
+    A new client is built only if the R2 settings change.
+    """
+    settings = _settings()
+    client = _clients.get(settings)
+    if client is not None:
+        return client
+    with _lock:
+        if settings not in _clients:
+            endpoint, key_id, secret, pool, attempts, retry_mode, connect_timeout, read_timeout = settings
+            _clients.clear()
+            _clients[settings] = boto3.client(
+                's3',
+                endpoint_url=endpoint,
+                aws_access_key_id=key_id,
+                aws_secret_access_key=secret,
+                config=Config(
+                    max_pool_connections=pool,
+                    retries={"total_max_attempts": attempts, "mode": retry_mode},
+                    connect_timeout=connect_timeout,
+                    read_timeout=read_timeout,
+                    tcp_keepalive=True,
+                ),
+            )
+        return _clients[settings]
@@ -0,0 +1,247 @@
+import hashlib
+import queue
+import subprocess
+import threading
+
+MB = 1024 * 1024
+
+# S3/R2 require every part except the last to be at least 5 MiB.
+MIN_PART_SIZE = 5 * MB
+READ_CHUNK_SIZE = 1 * MB
+
+
+class MultipartUploader:
+    """
+    File-like sink that uploads everything written to it as an S3 multipart upload.
+
+    Parts are handed to a background thread through a bounded queue, so at most
+    `max_pending` parts are held in memory while the producer keeps writing.
+    """
+
+    def __init__(self, s3, bucket, key, part_size=8 * MB, max_pending=4, metadata=None):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.metadata = metadata or {}
+        self.bytes_written = 0
+        self.sha256 = hashlib.sha256()
+
+        self._buffer = bytearray()
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._parts = []
+        self._upload_id = None
+        self._worker = None
+        self._error = None
+
+    def write(self, data):
+        if self._error:
+            raise self._error
+        self._buffer += data
+        self.bytes_written += len(data)
+        self.sha256.update(data)
+        while len(self._buffer) >= self.part_size:
+            part = bytes(self._buffer[:self.part_size])
+            del self._buffer[:self.part_size]
+            self._enqueue(part)
+        return len(data)
+
+    def close(self):
+        """Flushes the remaining buffer and completes the upload."""
+        if self._upload_id is None:
+            # Everything fit in a single part: a plain PUT is cheaper.
+            self.s3.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self._buffer), Metadata=self.metadata)
+            self._buffer = bytearray()
+            return
+
+        if self._buffer:
+            self._enqueue(bytes(self._buffer))
+            self._buffer = bytearray()
+        self._queue.put(None)
+        self._worker.join()
+        if self._error:
+            raise self._error
+
+        self.s3.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self._upload_id,
+            MultipartUpload={"Parts": self._parts},
+        )
+
+    def abort(self):
+        """Stops the worker and discards any parts already uploaded."""
+        if self._upload_id is None:
+            return
+        if self._worker.is_alive():
+            self._error = self._error or RuntimeError("Upload aborted")
+            self._drain_queue()
+            self._queue.put(None)
+            self._worker.join()
+        try:
+            self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id)
+        except Exception as e:
+            print(f"Failed to abort multipart upload for {self.key}: {e}")
+
+    def _enqueue(self, part):
+        if self._upload_id is None:
+            response = self.s3.create_multipart_upload(Bucket=self.bucket, Key=self.key, Metadata=self.metadata)
+            self._upload_id = response["UploadId"]
+            self._worker = threading.Thread(target=self._run, daemon=True)
+            self._worker.start()
+        # Blocks while the queue is full, which throttles the producer to network speed.
+        self._queue.put(part)
+        if self._error:
+            raise self._error
+
+    def _run(self):
+        part_number = 1
+        while True:
+            part = self._queue.get()
+            if part is None:
+                return
+            if self._error:
+                continue
+            try:
+                response = self.s3.upload_part(
+                    Bucket=self.bucket,
+                    Key=self.key,
+                    UploadId=self._upload_id,
+                    PartNumber=part_number,
+                    Body=part,
+                )
+                self._parts.append({"PartNumber": part_number, "ETag": response["ETag"]})
+                part_number += 1
+            except Exception as e:
+                self._error = e
+
+    def _drain_queue(self):
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                return
+
+
+def _collect_stderr(process, sink):
+    sink.append(process.stderr.read())
+
+
+def stream_dump(command, uploader, compressor, on_chunk=None):
+    """
+    Runs `command` (a pg_dump invocation) and pipes its stdout through `compressor` into `uploader`.
+    `on_chunk`, if given, is called with every uncompressed chunk (e.g. to index the dump).
+    Returns the number of uncompressed bytes read from the dump.
+    Raises subprocess.CalledProcessError if the dump exits non-zero.
+    """
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stderr = []
+    stderr_thread = threading.Thread(target=_collect_stderr, args=(process, stderr), daemon=True)
+    stderr_thread.start()
+
+    raw_bytes = 0
+    try:
+        while True:
+            chunk = process.stdout.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            raw_bytes += len(chunk)
+            if on_chunk:
+                on_chunk(chunk)
+            uploader.write(compressor.compress(chunk))
+        uploader.write(compressor.flush())
+    except Exception:
+        process.kill()
+        raise
+    finally:
+        process.stdout.close()
+        process.wait()
+        stderr_thread.join()
+
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command, stderr=b"".join(stderr))
+    return raw_bytes
+
+
+def read_file_chunks(path, chunk_size=READ_CHUNK_SIZE):
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+def pipe_into_process(chunks, command, decompressor=None):
+    """
+    Decompresses each chunk from the iterable `chunks` and writes it into the stdin of
+    `command` (psql or pg_restore). Blocking pipe writes throttle the producer to the
+    speed of the load. Returns the number of (compressed) bytes consumed.
+    Raises subprocess.CalledProcessError if the process exits non-zero.
+    """
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    stderr = []
+    stderr_thread = threading.Thread(target=_collect_stderr, args=(process, stderr), daemon=True)
+    stderr_thread.start()
+
+    consumed = 0
+    try:
+        for chunk in chunks:
+            consumed += len(chunk)
+            process.stdin.write(decompressor.decompress(chunk) if decompressor else chunk)
+        if decompressor:
+            process.stdin.write(decompressor.flush())
+        process.stdin.close()
+    except BrokenPipeError:
+        # The restore process died; its exit code and stderr explain why.
+        pass
+    except Exception:
+        process.kill()
+        raise
+    finally:
+        process.wait()
+        stderr_thread.join()
+
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command, stderr=b"".join(stderr))
+    return consumed
+
+
+def _download_chunks(body, chunks, stop, chunk_size):
+    try:
+        for chunk in body.iter_chunks(chunk_size):
+            if stop.is_set():
+                break
+            chunks.put(chunk)
+        chunks.put(None)
+    except Exception as e:
+        chunks.put(e)
+
+
+def prefetch_object(s3, bucket, key, chunk_size=READ_CHUNK_SIZE, max_pending=8):
+    """
+    Yields the body of `key` in chunks, read ahead by a download thread into a bounded
+    queue so the network keeps going while the consumer is busy.
+    """
+    body = s3.get_object(Bucket=bucket, Key=key)["Body"]
+    chunks = queue.Queue(maxsize=max_pending)
+    stop = threading.Event()
+    downloader = threading.Thread(target=_download_chunks, args=(body, chunks, stop, chunk_size), daemon=True)
+    downloader.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+    finally:
+        stop.set()
+        # Unblock the downloader if it is waiting on a full queue.
+        while downloader.is_alive():
+            try:
+                chunks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        body.close()
@@ -0,0 +1,181 @@
+import json
+
+from psycopg2 import sql
+
+from .export import _qualified
+from .selective import qualify
+
+SUBSET_SUFFIX = "_subset.copy"
+LINK_PREFIX = "linked_"
+LINK_KEY = "bubble_id"
+
+
+def link_target(table, column, tables, overrides=None):
+    """
+    The table a `linked_<x>` column points at (by bubble_id): an override for `table.column`
+    or `column`, else the table named <x> (or <x> without a plural s), else the only table
+    whose name ends in `_<x>`. None when nothing or more than one table fits.
+    """
+    overrides = overrides or {}
+    target = overrides.get(f"{table}.{column}") or overrides.get(column)
+    if target:
+        return target
+    stem = column[len(LINK_PREFIX):]
+    for candidate in (stem, stem[:-1] if stem.endswith("s") else None):
+        if candidate in tables:
+            return candidate
+    suffixed = [t for t in tables if t.endswith(f"_{stem}")]
+    return suffixed[0] if len(suffixed) == 1 else None
+
+
+def load_relations(path, overrides=None):
+    """
+    Reads the reference graph from schema_metadata.json: declared foreign keys, plus each
+    `linked_*` column as a reference to its target table's bubble_id (text or text[]).
+    Returns (relations, unresolved) where each relation is a dict with child/column/parent/
+    ref_column/array, and `unresolved` lists linked columns with no clear target.
+    """
+    with open(path) as f:
+        schema = json.load(f)
+    keyed = {name for name, table in schema.items() if any(c["name"] == LINK_KEY for c in table["columns"])}
+    relations, unresolved = [], []
+    for name, table in schema.items():
+        for fk in table.get("foreign_keys", []):
+            relations.append({
+                "child": qualify(name), "column": fk["column"],
+                "parent": qualify(fk["references_table"]), "ref_column": fk["references_column"], "array": False,
+            })
+        for column in table["columns"]:
+            if not column["name"].startswith(LINK_PREFIX):
+                continue
+            target = link_target(name, column["name"], keyed, overrides)
+            if target is None:
+                unresolved.append(f"{name}.{column['name']}")
+                continue
+            relations.append({
+                "child": qualify(name), "column": column["name"],
+                "parent": qualify(target), "ref_column": LINK_KEY, "array": column["type"] == "ARRAY",
+            })
+    return relations, unresolved
+
+
+def _table(name):
+    return _qualified(*name.split(".", 1))
+
+
+def _seed(cur, seed):
+    """ctids of a seed: rows of `table` matching `where`, optionally the first `limit` by `order_by`."""
+    query = sql.SQL("SELECT ctid FROM {}").format(_table(qualify(seed["table"])))
+    if seed.get("where"):
+        query = sql.SQL("{} WHERE {}").format(query, sql.SQL(seed["where"]))
+    if seed.get("order_by"):
+        query = sql.SQL("{} ORDER BY {}").format(query, sql.SQL(seed["order_by"]))
+    if seed.get("limit"):
+        query = sql.SQL("{} LIMIT {}").format(query, sql.Literal(int(seed["limit"])))
+    cur.execute(query)
+    return {row[0] for row in cur.fetchall()}
+
+
+def _parents(cur, rel, child_tids):
+    """ctids of `rel.parent` rows referenced by the given child rows (None: by every child row)."""
+    values = sql.SQL("unnest(c.{})" if rel["array"] else "c.{}").format(sql.Identifier(rel["column"]))
+    query = sql.SQL("SELECT p.ctid FROM {p} p WHERE p.{ref} IN (SELECT {v} FROM {c} c").format(
+        p=_table(rel["parent"]), ref=sql.Identifier(rel["ref_column"]), v=values, c=_table(rel["child"])
+    )
+    if child_tids is None:
+        cur.execute(sql.SQL("{})").format(query))
+    else:
+        cur.execute(sql.SQL("{} WHERE c.ctid = ANY(%s::tid[]))").format(query), (list(child_tids),))
+    return {row[0] for row in cur.fetchall()}
+
+
+def _children(cur, rel, parent_tids):
+    """ctids of `rel.child` rows referencing the given parent rows."""
+    keys = sql.SQL("SELECT p.{ref} FROM {p} p WHERE p.ctid = ANY(%s::tid[])").format(
+        ref=sql.Identifier(rel["ref_column"]), p=_table(rel["parent"])
+    )
+    match = sql.SQL("EXISTS (SELECT 1 FROM unnest(c.{col}) v WHERE v IN ({k}))" if rel["array"] else "c.{col} IN ({k})").format(
+        col=sql.Identifier(rel["column"]), k=keys
+    )
+    cur.execute(sql.SQL("SELECT c.ctid FROM {c} c WHERE {m}").format(c=_table(rel["child"]), m=match), (list(parent_tids),))
+    return {row[0] for row in cur.fetchall()}
+
+
+def compute_subset(cur, relations, seeds, full_tables=(), child_depth=1):
+    """
+    Selects a referentially closed subset, as ctids per table, inside the caller's snapshot
+    (ctids are stable within it, so export workers sharing the snapshot see the same rows).
+
+    Starts from `seeds` (see _seed) and every row of `full_tables`; follows references
+    from the seed rows down to rows that point at them for `child_depth` levels (e.g. an
+    invoice's invoice_items); then adds every row that a selected row references, until
+    nothing new is added. Full tables map to None rather than to a ctid set. Only reads,
+    so it runs in a read-only transaction.
+    """
+    tables = {r["child"] for r in relations} | {r["parent"] for r in relations}
+    cur.execute("SELECT name FROM unnest(%s::text[]) name WHERE to_regclass(name) IS NOT NULL", (sorted(tables),))
+    existing = {row[0] for row in cur.fetchall()}
+    relations = [r for r in relations if r["child"] in existing and r["parent"] in existing]
+    full = {qualify(table) for table in full_tables}
+    selected = {}
+
+    def add(table, tids):
+        if table in full:
+            return set()
+        new = tids - selected.setdefault(table, set())
+        selected[table] |= new
+        return new
+
+    frontier = {}
+    for seed in seeds:
+        table = qualify(seed["table"])
+        tids = _seed(cur, seed)
+        frontier.setdefault(table, set()).update(tids if table in full else add(table, tids))
+
+    for _ in range(child_depth):
+        step = {}
+        for rel in relations:
+            if frontier.get(rel["parent"]):
+                new = add(rel["child"], _children(cur, rel, frontier[rel["parent"]]))
+                if new:
+                    step.setdefault(rel["child"], set()).update(new)
+        if not step:
+            break
+        frontier = step
+
+    # Parent closure to a fixpoint, following only rows added since the last pass
+    # (None: every row of a full table).
+    frontier = {table: set(tids) for table, tids in selected.items() if tids}
+    frontier.update(dict.fromkeys(full))
+    while frontier:
+        step = {}
+        for rel in relations:
+            if rel["child"] in frontier:
+                new = add(rel["parent"], _parents(cur, rel, frontier[rel["child"]]))
+                if new:
+                    step.setdefault(rel["parent"], set()).update(new)
+        frontier = step
+    selected.update(dict.fromkeys(full))
+    return selected
+
+
+def subset_filter(relations, seeds, full_tables=(), child_depth=1):
+    """
+    table_filter for export_snapshot_backup: on its first call (inside the export snapshot)
+    computes the subset, then limits every table to its selected ctids, or to nothing.
+    Full tables get no filter. The computed ctid sets are kept in `table_filter.selected`.
+    """
+    full = {qualify(table) for table in full_tables}
+
+    def table_filter(cur, table):
+        if table["name"] in full:
+            return None
+        if table_filter.selected is None:
+            table_filter.selected = compute_subset(cur, relations, seeds, full_tables, child_depth)
+        tids = table_filter.selected.get(table["name"])
+        if not tids:
+            return sql.SQL("false")
+        return sql.SQL("ctid = ANY({}::tid[])").format(sql.Literal(sorted(tids)))
+
+    table_filter.selected = None
+    return table_filter
@@ -0,0 +1,94 @@
+from urllib.parse import urlparse
+
+import psycopg2
+from psycopg2 import errors, sql
+from psycopg2.extensions import make_dsn, parse_dsn
+
+
+def database_of(url):
+    return parse_dsn(url)["dbname"]
+
+
+def database_url(url, database):
+    """`url` pointing at another database on the same server."""
+    return urlparse(url)._replace(path=f"/{database}").geturl()
+
+
+def maintenance_connection(url):
+    """
+    Autocommit connection to the `postgres` database of the server behind `url`, for
+    CREATE/DROP/ALTER DATABASE, which cannot run inside a transaction or on the database
+    they act on.
+    """
+    conn = psycopg2.connect(make_dsn(url, dbname="postgres"))
+    conn.autocommit = True
+    return conn
+
+
+def terminate_connections(cur, database):
+    cur.execute(
+        "SELECT pg_terminate_backend(pid) FROM pg_stat_activity WHERE datname = %s AND pid <> pg_backend_pid()",
+        (database,),
+    )
+
+
+def database_exists(cur, database):
+    cur.execute("SELECT 1 FROM pg_database WHERE datname = %s", (database,))
+    return cur.fetchone() is not None
+
+
+def create_database(cur, database):
+    cur.execute(sql.SQL("CREATE DATABASE {}").format(sql.Identifier(database)))
+
+
+def drop_database(cur, database):
+    if not database_exists(cur, database):
+        return
+    # A template database cannot be dropped until it is an ordinary one again.
+    cur.execute(sql.SQL("ALTER DATABASE {} WITH IS_TEMPLATE false ALLOW_CONNECTIONS true").format(sql.Identifier(database)))
+    terminate_connections(cur, database)
+    cur.execute(sql.SQL("DROP DATABASE {}").format(sql.Identifier(database)))
+
+
+def clone_database(cur, source, target):
+    """
+    Creates `target` as a copy of `source` with CREATE DATABASE ... TEMPLATE. The data
+    files are copied as they are; nothing is replayed. On PostgreSQL 15+ FILE_COPY is
+    requested explicitly, since the WAL_LOG default there writes every block to WAL.
+    """
+    cur.execute("SHOW server_version_num")
+    strategy = sql.SQL(" STRATEGY FILE_COPY") if int(cur.fetchone()[0]) >= 150000 else sql.SQL("")
+    terminate_connections(cur, source)
+    cur.execute(sql.SQL("CREATE DATABASE {} TEMPLATE {}{}").format(sql.Identifier(target), sql.Identifier(source), strategy))
+
+
+def mark_template(cur, database):
+    """Freezes `database` as a template: clonable, but nobody can connect and change it."""
+    cur.execute(sql.SQL("ALTER DATABASE {} WITH IS_TEMPLATE true ALLOW_CONNECTIONS false").format(sql.Identifier(database)))
+    terminate_connections(cur, database)
+
+
+def swap_in(cur, database, replacement, attempts=3):
+    """
+    Puts `replacement` in place of `database` with both renames in one transaction, then
+    drops the old copy. Clients are disconnected only for the renames, not while the
+    replacement is built; if one reconnects in between, the swap is retried.
+    """
+    retired = f"{database}_old"[:63]
+    drop_database(cur, retired)
+    exists = database_exists(cur, database)
+    for attempt in range(attempts):
+        if exists:
+            terminate_connections(cur, database)
+        try:
+            cur.execute("BEGIN")
+            if exists:
+                cur.execute(sql.SQL("ALTER DATABASE {} RENAME TO {}").format(sql.Identifier(database), sql.Identifier(retired)))
+            cur.execute(sql.SQL("ALTER DATABASE {} RENAME TO {}").format(sql.Identifier(replacement), sql.Identifier(database)))
+            cur.execute("COMMIT")
+            break
+        except errors.ObjectInUse:
+            cur.execute("ROLLBACK")
+            if attempt == attempts - 1:
+                raise
+    drop_database(cur, retired)
@@ -0,0 +1,217 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+
+from .streaming import MB, MIN_PART_SIZE
+
+CHECKPOINT_SUFFIX = ".upload.json"
+
+
+def _retry(fn, retries, what):
+    """Calls `fn`, retrying with exponential backoff (1s, 2s, 4s, ...) up to `retries` times."""
+    for attempt in range(retries + 1):
+        try:
+            return fn()
+        except Exception as e:
+            if attempt == retries:
+                raise
+            delay = 2 ** attempt
+            print(f"{what} failed ({e}), retrying in {delay}s")
+            time.sleep(delay)
+
+
+class ResumableUpload:
+    """
+    Uploads a local file as an S3 multipart upload with `concurrency` parts in flight,
+    checkpointing the upload id and every completed part's ETag to `<path>.upload.json`.
+
+    If the upload fails, the file and checkpoint are left in place; calling upload() again
+    (in this process or a later one) asks R2 which parts it already holds and only sends
+    the rest. Files below `threshold` go up in a single PUT.
+    """
+
+    def __init__(self, s3, bucket, key, path, part_size=16 * MB, concurrency=8, threshold=64 * MB, retries=3, metadata=None):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.path = path
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.concurrency = concurrency
+        self.threshold = threshold
+        self.retries = retries
+        self.metadata = metadata or {}
+        self.checkpoint_path = path + CHECKPOINT_SUFFIX
+        self.resumed_parts = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_checkpoint(cls, s3, checkpoint_path, **kwargs):
+        """Rebuilds an interrupted upload from its checkpoint file."""
+        with open(checkpoint_path) as f:
+            state = json.load(f)
+        return cls(
+            s3, state["bucket"], state["key"], checkpoint_path[:-len(CHECKPOINT_SUFFIX)],
+            part_size=state["part_size"], metadata=state.get("metadata"), **kwargs,
+        )
+
+    def upload(self):
+        size = os.path.getsize(self.path)
+        if size < self.threshold and not os.path.exists(self.checkpoint_path):
+            with open(self.path, "rb") as f:
+                _retry(lambda: self.s3.put_object(Bucket=self.bucket, Key=self.key, Body=f.read(), Metadata=self.metadata), self.retries, f"Upload of {self.key}")
+            return size
+
+        state = self._load_checkpoint(size)
+        part_count = (size + self.part_size - 1) // self.part_size
+        missing = [n for n in range(1, part_count + 1) if str(n) not in state["parts"]]
+        self.resumed_parts = part_count - len(missing)
+        if self.resumed_parts:
+            print(f"Resuming upload of {self.key}: {self.resumed_parts}/{part_count} parts already uploaded")
+
+        def send(part_number):
+            with open(self.path, "rb") as f:
+                f.seek((part_number - 1) * self.part_size)
+                body = f.read(self.part_size)
+            response = _retry(
+                lambda: self.s3.upload_part(Bucket=self.bucket, Key=self.key, UploadId=state["upload_id"], PartNumber=part_number, Body=body),
+                self.retries,
+                f"Part {part_number} of {self.key}",
+            )
+            with self._lock:
+                state["parts"][str(part_number)] = response["ETag"]
+                self._save_checkpoint(state)
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            list(pool.map(send, missing))
+
+        parts = [{"PartNumber": n, "ETag": state["parts"][str(n)]} for n in range(1, part_count + 1)]
+        _retry(
+            lambda: self.s3.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=state["upload_id"], MultipartUpload={"Parts": parts}),
+            self.retries,
+            f"Completing {self.key}",
+        )
+        os.remove(self.checkpoint_path)
+        return size
+
+    def abort(self):
+        """Gives up on the upload for good: discards uploaded parts and the checkpoint."""
+        if not os.path.exists(self.checkpoint_path):
+            return
+        with open(self.checkpoint_path) as f:
+            state = json.load(f)
+        try:
+            self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=state["upload_id"])
+        except Exception as e:
+            print(f"Failed to abort multipart upload for {self.key}: {e}")
+        os.remove(self.checkpoint_path)
+
+    def _load_checkpoint(self, size):
+        """Returns the saved upload state if it still matches the file and R2, else starts a new upload."""
+        if os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path) as f:
+                state = json.load(f)
+            if (state["key"], state["size"], state["mtime"], state["part_size"]) == (self.key, size, os.path.getmtime(self.path), self.part_size):
+                try:
+                    # Trust only parts R2 confirms it still holds.
+                    listed = {}
+                    for page in self.s3.get_paginator("list_parts").paginate(Bucket=self.bucket, Key=self.key, UploadId=state["upload_id"]):
+                        listed.update({str(p["PartNumber"]): p["ETag"] for p in page.get("Parts", [])})
+                    state["parts"] = {n: etag for n, etag in state["parts"].items() if listed.get(n) == etag}
+                    return state
+                except ClientError as e:
+                    print(f"Checkpointed upload of {self.key} is gone ({e}), starting over")
+
+        response = self.s3.create_multipart_upload(Bucket=self.bucket, Key=self.key, Metadata=self.metadata)
+        state = {
+            "bucket": self.bucket,
+            "key": self.key,
+            "upload_id": response["UploadId"],
+            "size": size,
+            "mtime": os.path.getmtime(self.path),
+            "part_size": self.part_size,
+            "metadata": self.metadata,
+            "parts": {},
+        }
+        self._save_checkpoint(state)
+        return state
+
+    def _save_checkpoint(self, state):
+        tmp = self.checkpoint_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp, self.checkpoint_path)
+
+
+def pending_uploads(spool_dir):
+    """Checkpoint files of uploads interrupted in `spool_dir`."""
+    if not os.path.isdir(spool_dir):
+        return []
+    return sorted(os.path.join(spool_dir, name) for name in os.listdir(spool_dir) if name.endswith(CHECKPOINT_SUFFIX))
+
+
+def _fetch_range(s3, bucket, key, etag, start, end, retries):
+    # IfMatch pins every range to the same object version.
+    return _retry(
+        lambda: s3.get_object(Bucket=bucket, Key=key, Range=f"bytes={start}-{end}", IfMatch=etag)["Body"].read(),
+        retries,
+        f"Range {start}-{end} of {key}",
+    )
+
+
+def _ranges(size, range_size, first=0):
+    return [(start, min(start + range_size, size) - 1) for start in range(first, size, range_size)]
+
+
+def ranged_chunks(s3, bucket, key, range_size=16 * MB, concurrency=8, retries=3, first=0, last=None):
+    """
+    Yields the body of `key` in order, fetched as `range_size` byte ranges over
+    `concurrency` parallel GETs, so one slow connection does not cap throughput.
+    Each range is retried on its own. At most `concurrency` ranges are held in memory.
+    `first` and `last` (inclusive) limit it to a byte range of the object.
+    """
+    head = s3.head_object(Bucket=bucket, Key=key)
+    size = head["ContentLength"] if last is None else min(last + 1, head["ContentLength"])
+    ranges = iter(_ranges(size, range_size, first))
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        pending = deque()
+        for start, end in ranges:
+            pending.append(pool.submit(_fetch_range, s3, bucket, key, head["ETag"], start, end, retries))
+            if len(pending) >= concurrency:
+                break
+        try:
+            while pending:
+                data = pending.popleft().result()
+                following = next(ranges, None)
+                if following:
+                    pending.append(pool.submit(_fetch_range, s3, bucket, key, head["ETag"], *following, retries))
+                yield data
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def ranged_download(s3, bucket, key, path, range_size=16 * MB, concurrency=8, retries=3):
+    """
+    Downloads `key` to `path` with `concurrency` parallel ranged GETs, each written at its
+    offset as soon as it arrives. Returns the object size.
+    """
+    head = s3.head_object(Bucket=bucket, Key=key)
+    size = head["ContentLength"]
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(fd, size)
+
+        def fetch(byte_range):
+            start, end = byte_range
+            os.pwrite(fd, _fetch_range(s3, bucket, key, head["ETag"], start, end, retries), start)
+
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(fetch, _ranges(size, range_size)))
+    finally:
+        os.close(fd)
+    return size
@@ -0,0 +1,342 @@
+import datetime
+import os
+import re
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import threading
+import time
+
+import psycopg2
+from psycopg2.extensions import parse_dsn
+
+from .export import _CompressingWriter
+from .manifest import new_manifest, write_manifest, load_manifest, MANIFEST_SUFFIX
+from .streaming import MultipartUploader, stream_dump, prefetch_object, pipe_into_process
+from .transfer import ranged_chunks
+
+WAL_PREFIX = "wal/"
+BASE_PREFIX = "basebackups/"
+FORMAT_BASE = "basebackup"
+PARTIAL_SUFFIX = ".partial"
+SEGMENT_RE = re.compile(r"^[0-9A-F]{24}$")
+# Written by pg_receivewal on a timeline switch; recovery past a failover needs them.
+HISTORY_RE = re.compile(r"^[0-9A-F]{8}\.history$")
+
+
+def _segment_range(key):
+    """`wal/<first>_<last>.tar.zst` -> (first, last)"""
+    first, _, rest = key[len(WAL_PREFIX):].partition("_")
+    return first, rest[:24]
+
+
+class WalArchiver:
+    """
+    Streams WAL from the primary with `pg_receivewal` over a physical replication slot
+    and ships it to `wal/` in the bucket.
+
+    Completed 16 MB segments are bundled into one compressed tar per batch (every
+    `batch_segments` segments or `batch_seconds`, whichever comes first), so R2 sees a few
+    large PUTs rather than one per segment. The segment still being written is uploaded
+    as `wal/<segment>.partial` on every batch, which bounds data loss to roughly
+    `batch_seconds` even when the database is quiet and segments fill slowly.
+    The slot makes the primary keep WAL until it has been received, so restarts lose nothing.
+    """
+
+    def __init__(self, database_url, s3, bucket, spool_dir, codec, level=None, slot="backup_service", batch_segments=16, batch_seconds=60):
+        self.database_url = database_url
+        self.s3 = s3
+        self.bucket = bucket
+        self.spool_dir = spool_dir
+        self.codec = codec
+        self.level = level
+        self.slot = slot
+        self.batch_segments = batch_segments
+        self.batch_seconds = batch_seconds
+        self.last_error = None
+        self._process = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._partial_uploaded = None
+
+    def start(self):
+        os.makedirs(self.spool_dir, exist_ok=True)
+        subprocess.run(
+            ["pg_receivewal", "--slot", self.slot, "--create-slot", "--if-not-exists", "-d", self.database_url],
+            check=True, capture_output=True,
+        )
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._process and self._process.poll() is None:
+            self._process.terminate()
+            self._process.wait()
+        if self._thread:
+            self._thread.join()
+        self.flush()
+
+    def _spawn(self):
+        self._process = subprocess.Popen(
+            ["pg_receivewal", "-D", self.spool_dir, "--slot", self.slot, "--synchronous", "-d", self.database_url],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+
+    def _run(self):
+        last_flush = time.monotonic()
+        while not self._stop.is_set():
+            if self._process is None or self._process.poll() is not None:
+                if self._process is not None:
+                    print(f"pg_receivewal exited with {self._process.returncode}, restarting")
+                self._spawn()
+            due = time.monotonic() - last_flush >= self.batch_seconds
+            if due or len(self._completed_segments()) >= self.batch_segments:
+                try:
+                    self.flush()
+                    self.last_error = None
+                except Exception as e:
+                    self.last_error = str(e)
+                    print(f"WAL upload failed: {e}")
+                last_flush = time.monotonic()
+            self._stop.wait(1)
+
+    def _completed_segments(self):
+        return sorted(name for name in os.listdir(self.spool_dir) if SEGMENT_RE.match(name))
+
+    def flush(self):
+        """Uploads completed segments as one bundle, then the in-progress segment."""
+        segments = self._completed_segments()
+        if segments:
+            key = f"{WAL_PREFIX}{segments[0]}_{segments[-1]}.tar{self.codec.extension}"
+            writer = _CompressingWriter(MultipartUploader(self.s3, self.bucket, key, metadata={"codec": self.codec.name}), self.codec.compressor(self.level))
+            try:
+                with tarfile.open(fileobj=writer, mode="w|") as tar:
+                    for name in segments:
+                        tar.add(os.path.join(self.spool_dir, name), arcname=name)
+                writer.close()
+            except Exception:
+                writer.uploader.abort()
+                raise
+            for name in segments:
+                os.remove(os.path.join(self.spool_dir, name))
+            print(f"Archived {len(segments)} WAL segment(s) to {key}")
+
+        for name in sorted(name for name in os.listdir(self.spool_dir) if HISTORY_RE.match(name)):
+            path = os.path.join(self.spool_dir, name)
+            with open(path, "rb") as f:
+                self.s3.put_object(Bucket=self.bucket, Key=f"{WAL_PREFIX}{name}", Body=f.read())
+            os.remove(path)
+            print(f"Archived timeline history {name}")
+
+        partials = sorted(name for name in os.listdir(self.spool_dir) if name.endswith(PARTIAL_SUFFIX))
+        if partials:
+            path = os.path.join(self.spool_dir, partials[-1])
+            state = (partials[-1], os.path.getmtime(path))
+            if state != self._partial_uploaded:
+                with open(path, "rb") as f:
+                    body = self.codec.compress(f.read(), self.level)
+                self.s3.put_object(Bucket=self.bucket, Key=f"{WAL_PREFIX}{partials[-1]}{self.codec.extension}", Body=body, Metadata={"codec": self.codec.name})
+                if self._partial_uploaded and self._partial_uploaded[0] != partials[-1]:
+                    self.s3.delete_object(Bucket=self.bucket, Key=f"{WAL_PREFIX}{self._partial_uploaded[0]}{self.codec.extension}")
+                self._partial_uploaded = state
+
+
+def drop_slot(database_url, slot):
+    """
+    Drops replication slot `slot` unless something is streaming from it, so a primary no
+    longer archived to stops keeping WAL for it. Returns True when a slot was dropped.
+    """
+    conn = psycopg2.connect(database_url)
+    conn.autocommit = True
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT pg_drop_replication_slot(slot_name) FROM pg_replication_slots WHERE slot_name = %s AND NOT active", (slot,))
+        return cur.rowcount > 0
+    finally:
+        conn.close()
+
+
+def base_backup(database_url, s3, bucket, name, codec, level=None, part_size=8 * 1024 * 1024):
+    """
+    Streams `pg_basebackup -Ft -D -` (tar of the data directory, no WAL) through `codec`
+    into `basebackups/<name>.tar<ext>`. WAL needed to make it consistent comes from the
+    archive, so the archiver must be running. The manifest records the first WAL segment
+    replay needs. Only works for clusters without extra tablespaces.
+    Returns the manifest dict.
+    """
+    conn = psycopg2.connect(database_url)
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT pg_walfile_name(pg_current_wal_lsn()), now()")
+        start_segment, started_at = cur.fetchone()
+    finally:
+        conn.close()
+
+    key = f"{BASE_PREFIX}{name}.tar{codec.extension}"
+    uploader = MultipartUploader(s3, bucket, key, part_size=part_size, metadata={"backup-format": FORMAT_BASE, "codec": codec.name})
+    try:
+        raw_bytes = stream_dump(
+            ["pg_basebackup", "-d", database_url, "-D", "-", "-Ft", "-X", "none", "--checkpoint=fast"],
+            uploader,
+            codec.compressor(level),
+        )
+        uploader.close()
+    except Exception:
+        uploader.abort()
+        raise
+
+    manifest = new_manifest(
+        key,
+        FORMAT_BASE,
+        codec.name,
+        start_segment=start_segment,
+        started_at=started_at.isoformat(),
+        finished_at=datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        raw_size=raw_bytes,
+        size=uploader.bytes_written,
+        sha256=uploader.sha256.hexdigest(),
+    )
+    write_manifest(s3, bucket, key, manifest)
+    return manifest
+
+
+def _list_keys(s3, bucket, prefix):
+    keys = []
+    for page in s3.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix):
+        keys.extend(obj["Key"] for obj in page.get("Contents", []))
+    return keys
+
+
+def choose_base_backup(s3, bucket, target_time):
+    """The latest base backup that finished before `target_time` (an aware datetime)."""
+    best = None
+    for key in _list_keys(s3, bucket, BASE_PREFIX):
+        if not key.endswith(MANIFEST_SUFFIX):
+            continue
+        manifest = load_manifest(s3, bucket, key[:-len(MANIFEST_SUFFIX)])
+        if datetime.datetime.fromisoformat(manifest["finished_at"]) <= target_time:
+            if best is None or manifest["finished_at"] > best["finished_at"]:
+                best = manifest
+    return best
+
+
+def fetch_wal(s3, bucket, start_segment, wal_dir, codec_for):
+    """
+    Downloads every archived segment from `start_segment` on into `wal_dir`, including the
+    newest partial segment (renamed to a full segment, as pg_receivewal documents), and
+    every timeline history file.
+    `codec_for(key, metadata)` picks the decompressor for each object.
+    """
+    os.makedirs(wal_dir, exist_ok=True)
+    keys = _list_keys(s3, bucket, WAL_PREFIX)
+    for key in sorted(k for k in keys if ".tar" in k):
+        first, last = _segment_range(key)
+        if last[8:] < start_segment[8:]:
+            continue
+        codec = codec_for(key, s3.head_object(Bucket=bucket, Key=key).get("Metadata"))
+        pipe_into_process(prefetch_object(s3, bucket, key), ["tar", "-x", "-C", wal_dir], codec.decompressor())
+
+    for key in keys:
+        name = key[len(WAL_PREFIX):]
+        if HISTORY_RE.match(name):
+            with open(os.path.join(wal_dir, name), "wb") as f:
+                f.write(s3.get_object(Bucket=bucket, Key=key)["Body"].read())
+
+    partials = sorted(k for k in keys if PARTIAL_SUFFIX in k)
+    if partials:
+        key = partials[-1]
+        segment = key[len(WAL_PREFIX):len(WAL_PREFIX) + 24]
+        if not os.path.exists(os.path.join(wal_dir, segment)):
+            codec = codec_for(key, s3.head_object(Bucket=bucket, Key=key).get("Metadata"))
+            body = s3.get_object(Bucket=bucket, Key=key)["Body"].read()
+            decompressor = codec.decompressor()
+            with open(os.path.join(wal_dir, segment), "wb") as f:
+                f.write(decompressor.decompress(body) + decompressor.flush())
+
+
+def pitr_unavailable(pg_bin_dir=""):
+    """Why point_in_time_restore cannot run in this environment, or None when it can."""
+    if not shutil.which(os.path.join(pg_bin_dir, "pg_ctl")):
+        return f"pg_ctl not found in {pg_bin_dir or 'PATH'}; install the PostgreSQL server binaries and set PG_BIN_DIR"
+    if hasattr(os, "geteuid") and os.geteuid() == 0:
+        return "pg_ctl refuses to run as root; run the service as an unprivileged user"
+    return None
+
+
+def point_in_time_restore(s3, bucket, database_url, target_url, target_time, codec_for, pg_bin_dir="", port=54329, timeout=3600, download_concurrency=8):
+    """
+    Rebuilds the database as of `target_time` and loads it into `target_url`.
+
+    A throwaway PostgreSQL cluster is started from the newest base backup before
+    `target_time` with `recovery_target_time` set and a restore_command reading the
+    downloaded WAL; once it has replayed up to the target and promoted, its database is
+    copied into `target_url` with pg_dump | psql. Needs PostgreSQL server binaries of the
+    production major version (`pg_bin_dir`) and must not run as root.
+    Returns the base backup manifest used.
+    """
+    base = choose_base_backup(s3, bucket, target_time)
+    if base is None:
+        raise ValueError(f"No base backup finished before {target_time.isoformat()}")
+
+    workdir = tempfile.mkdtemp(prefix="pitr_")
+    data_dir = os.path.join(workdir, "data")
+    wal_dir = os.path.join(workdir, "wal")
+    pg_ctl = os.path.join(pg_bin_dir, "pg_ctl")
+    started = False
+    try:
+        os.makedirs(data_dir, mode=0o700)
+        codec = codec_for(base["backup"], {"codec": base["codec"]})
+        chunks = ranged_chunks(s3, bucket, base["backup"], concurrency=download_concurrency)
+        pipe_into_process(chunks, ["tar", "-x", "-C", data_dir], codec.decompressor())
+        fetch_wal(s3, bucket, base["start_segment"], wal_dir, codec_for)
+
+        # Local-only cluster: trust auth over a private socket, recovery settings last so they win.
+        with open(os.path.join(data_dir, "pg_hba.conf"), "w") as f:
+            f.write("local all all trust\n")
+        open(os.path.join(data_dir, "postgresql.conf"), "a").close()
+        open(os.path.join(data_dir, "recovery.signal"), "w").close()
+        with open(os.path.join(data_dir, "postgresql.auto.conf"), "a") as f:
+            f.write(
+                f"\nport = {port}\n"
+                "listen_addresses = ''\n"
+                f"unix_socket_directories = '{workdir}'\n"
+                "archive_mode = off\n"
+                f"restore_command = 'cp {wal_dir}/%f %p'\n"
+                f"recovery_target_time = '{target_time.isoformat()}'\n"
+                "recovery_target_action = 'promote'\n"
+            )
+
+        subprocess.run([pg_ctl, "-D", data_dir, "-l", os.path.join(workdir, "server.log"), "-w", "start"], check=True, capture_output=True)
+        started = True
+
+        source = parse_dsn(database_url)
+        local = f"host={workdir} port={port} dbname={source.get('dbname', 'postgres')} user={source.get('user', 'postgres')}"
+        deadline = time.monotonic() + timeout
+        while True:
+            conn = psycopg2.connect(local)
+            try:
+                cur = conn.cursor()
+                cur.execute("SELECT pg_is_in_recovery()")
+                if not cur.fetchone()[0]:
+                    break
+            finally:
+                conn.close()
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"WAL replay did not reach {target_time.isoformat()} within {timeout}s")
+            time.sleep(2)
+
+        dump = subprocess.Popen(["pg_dump", "--no-owner", "--no-privileges", local], stdout=subprocess.PIPE)
+        load = subprocess.run(["psql", target_url, "--quiet"], stdin=dump.stdout, capture_output=True)
+        dump.stdout.close()
+        if dump.wait() != 0:
+            raise subprocess.CalledProcessError(dump.returncode, "pg_dump", stderr=b"pg_dump of the recovered cluster failed")
+        if load.returncode != 0:
+            raise subprocess.CalledProcessError(load.returncode, "psql", stderr=load.stderr)
+        return base
+    finally:
+        if started:
+            subprocess.run([pg_ctl, "-D", data_dir, "-m", "immediate", "stop"], capture_output=True)
+        shutil.rmtree(workdir, ignore_errors=True)
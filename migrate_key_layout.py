@@ -0,0 +1,101 @@
+import argparse
+import json
+
+from dotenv import load_dotenv
+
+from app.backup import get_config, get_state, set_state, validate_config
+from app.catalog import rebuild_catalog, walk_backups
+from app.layout import key_for, database_name, LAYOUT_FLAT
+from app.manifest import manifest_key
+from app.retention import backup_objects, delete_keys
+from app.storage import get_s3_client
+
+load_dotenv()
+
+# Backup names kept in _admin_backup_state that must follow their objects.
+STATE_KEYS = ("incremental_chain", "last_copy_backup")
+
+
+def remap(value, mapping):
+    """Rewrites every string in a manifest that names a moved backup or an object inside one."""
+    if isinstance(value, str):
+        head, sep, rest = value.partition("/")
+        return mapping[head] + sep + rest if head in mapping else value
+    if isinstance(value, list):
+        return [remap(v, mapping) for v in value]
+    if isinstance(value, dict):
+        return {k: remap(v, mapping) for k, v in value.items()}
+    return value
+
+
+def copy_object(s3, bucket, source, target):
+    # Managed copy switches to multipart copy for large objects; metadata is carried explicitly
+    # because multipart copies do not inherit it.
+    head = s3.head_object(Bucket=bucket, Key=source)
+    extra = {"Metadata": head.get("Metadata", {}), "MetadataDirective": "REPLACE"}
+    if head.get("ContentType"):
+        extra["ContentType"] = head["ContentType"]
+    s3.copy({"Bucket": bucket, "Key": source}, bucket, target, ExtraArgs=extra)
+
+
+def migrate(dry_run=False, keep_originals=False):
+    """
+    Moves backups stored at the bucket root to BACKUP_KEY_LAYOUT with server-side copies,
+    rewrites manifests that reference the old keys, then deletes the originals and
+    rebuilds the catalog.
+    """
+    config = get_config()
+    validate_config(config, ["R2_ENDPOINT_URL", "R2_ACCESS_KEY_ID", "R2_SECRET_ACCESS_KEY", "R2_BUCKET_NAME"])
+    layout = config["BACKUP_KEY_LAYOUT"]
+    if layout == LAYOUT_FLAT:
+        print("BACKUP_KEY_LAYOUT is flat; set it to the target layout first, e.g. db/{db}/{yyyy}/{mm}/{dd}")
+        return
+
+    s3 = get_s3_client()
+    bucket = config["R2_BUCKET_NAME"]
+    db = database_name(config["DATABASE_URL"])
+    mapping = {}
+    for name in walk_backups(s3, bucket, ""):
+        if "/" not in name and key_for(name, layout, db) != name:
+            mapping[name] = key_for(name, layout, db)
+    if not mapping:
+        print("Nothing to migrate.")
+        return
+
+    moved = []
+    for old, new in sorted(mapping.items()):
+        keys = backup_objects(s3, bucket, old)
+        print(f"{old} -> {new} ({len(keys)} objects)")
+        if dry_run:
+            continue
+        for key in keys:
+            target = new + key[len(old):]
+            copy_object(s3, bucket, key, target)
+            moved.append(key)
+        # Manifests name their own objects and, for incremental/reused COPY backups, other backups.
+        new_manifest_key = manifest_key(new)
+        manifest = json.loads(s3.get_object(Bucket=bucket, Key=new_manifest_key)["Body"].read()) if manifest_key(old) in keys else None
+        if manifest is not None:
+            s3.put_object(Bucket=bucket, Key=new_manifest_key, Body=json.dumps(remap(manifest, mapping), indent=2).encode(), ContentType="application/json")
+
+    if dry_run:
+        return
+
+    for key in STATE_KEYS:
+        value = get_state(key)
+        if value:
+            set_state(key, remap(value, mapping))
+
+    if not keep_originals:
+        delete_keys(s3, bucket, moved)
+
+    backups = rebuild_catalog(s3, bucket)
+    print(f"Migrated {len(mapping)} backups ({len(moved)} objects); catalog now lists {len(backups)} backups.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-key existing backups to BACKUP_KEY_LAYOUT with server-side copies.")
+    parser.add_argument("--dry-run", action="store_true", help="only print what would move")
+    parser.add_argument("--keep-originals", action="store_true", help="copy without deleting the old keys")
+    args = parser.parse_args()
+    migrate(dry_run=args.dry_run, keep_originals=args.keep_originals)